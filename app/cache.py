@@ -0,0 +1,387 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+from collections import Counter, OrderedDict
+from datetime import date, datetime
+from parser.async_download.cache_generation import (GENERATION_KEY,
+                                                    GENERATION_LSN_KEY)
+from parser.async_download.database import fill_session
+from time import time
+from uuid import uuid4
+
+from dotenv import load_dotenv
+from redis import asyncio as aioredis
+from sqlalchemy import text
+
+load_dotenv()
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_DB = int(os.getenv("REDIS_DB", "0"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+# Время жизни записей кеша, секунды (с запасом на выходные без торгов)
+CACHE_TTL = int(os.getenv("CACHE_TTL", str(7 * 24 * 60 * 60)))
+
+# Сколько ключей с результатами запросов хранится одновременно (вытесняются давно не читанные)
+CACHE_MAX_KEYS = int(os.getenv("CACHE_MAX_KEYS", "1000"))
+# Блокировка в Redis на время запроса к базе (для нескольких воркеров uvicorn)
+CACHE_LOCK = os.getenv("CACHE_LOCK", "false").lower() == "true"
+CACHE_LOCK_TIMEOUT = float(os.getenv("CACHE_LOCK_TIMEOUT", "10"))
+CACHE_LOCK_POLL_INTERVAL = 0.05
+# Сжатие ответов в кеше (gzip) и минимальный размер ответа для сжатия, байты
+CACHE_COMPRESS = os.getenv("CACHE_COMPRESS", "false").lower() == "true"
+CACHE_COMPRESS_MIN_SIZE = int(os.getenv("CACHE_COMPRESS_MIN_SIZE", "4096"))
+# Локальный (in-process) кеш готовых ответов: размер и время жизни записей, секунды
+L1_MAX_ITEMS = int(os.getenv("L1_MAX_ITEMS", "256"))
+L1_TTL = float(os.getenv("L1_TTL", "60"))
+# Как часто локальный кеш сверяет поколение данных с Redis, секунды
+GENERATION_CHECK_INTERVAL = float(os.getenv("GENERATION_CHECK_INTERVAL", "1"))
+CACHE_PREFIX = "spimex"
+# Версия формата значений кеша: меняется, когда меняется содержимое ответа
+CACHE_VERSION = 3
+# Отсортированное множество ключей кеша по времени последнего обращения
+INDEX_KEY = f"{CACHE_PREFIX}:keys"
+
+# Удаляет блокировку, только если в ней записан наш токен
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+pool = aioredis.ConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=REDIS_DB,
+    max_connections=REDIS_MAX_CONNECTIONS,
+)
+client = aioredis.Redis(connection_pool=pool)
+
+# Задачи загрузки, выполняющиеся сейчас, по (ключ кеша, поколение данных)
+inflight = {}
+
+# Счетчики попаданий и промахов по уровням кеша
+stats = {"l1": Counter(), "redis": Counter()}
+
+
+class LocalCache:
+    """
+    Ограниченный по размеру LRU-кеш готовых ответов с временем жизни записей.
+    Запись действительна, только пока не сменилось поколение данных.
+    """
+
+    def __init__(self, max_items, ttl):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.items = OrderedDict()
+
+    def get(self, key, generation):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        expires_at, item_generation, payload = item
+        if item_generation != generation or expires_at < time():
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return payload
+
+    def set(self, key, generation, payload):
+        self.items[key] = (time() + self.ttl, generation, payload)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+
+local_cache = LocalCache(L1_MAX_ITEMS, L1_TTL)
+
+# Последнее известное поколение данных, позиция WAL его загрузки и время проверки
+known_generation = {"value": 0, "lsn": None, "checked_at": 0.0}
+
+
+async def check_redis():
+    """
+    Проверяет доступность Redis при старте приложения.
+    """
+    try:
+        await client.ping()
+    except Exception as e:
+        raise RuntimeError(
+            f"Redis недоступен ({REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}): {e}"
+        ) from e
+
+
+async def close_redis():
+    await client.aclose()
+
+
+def normalize(value):
+    """Приводит значение параметра запроса к виду, пригодному для ключа кеша."""
+    if hasattr(value, "model_dump"):
+        value = value.model_dump()
+    if isinstance(value, dict):
+        return {k: normalize(v) for k, v in value.items()}
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def make_key(endpoint, **params):
+    """
+    Строит канонический ключ кеша по эндпоинту и параметрам запроса.
+    Параметры со значением None не влияют на ключ.
+    """
+    normalized = {k: normalize(v) for k, v in params.items() if v is not None}
+    raw = json.dumps(normalized, sort_keys=True, separators=(",", ":"), default=str)
+    digest = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    return f"{CACHE_PREFIX}:v{CACHE_VERSION}:{endpoint}:{digest}"
+
+
+async def cache_get(key):
+    """
+    Читает текущее поколение данных и значение из кеша за одно обращение к Redis,
+    отмечая обращение к ключу.
+
+    Возвращает:
+    - (поколение, bytes или None при промахе).
+    """
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.get(GENERATION_KEY)
+        pipe.get(GENERATION_LSN_KEY)
+        pipe.get(key)
+        pipe.zadd(INDEX_KEY, {key: time()}, xx=True)
+        generation, lsn, value, _ = await pipe.execute()
+    generation = int(generation or 0)
+    remember_generation(generation, lsn)
+    return generation, value
+
+
+def remember_generation(generation, lsn):
+    known_generation["value"] = generation
+    known_generation["lsn"] = lsn.decode("ascii") if lsn else None
+    known_generation["checked_at"] = time()
+
+
+async def current_generation():
+    """
+    Возвращает поколение данных, обращаясь к Redis не чаще GENERATION_CHECK_INTERVAL.
+    """
+    if time() - known_generation["checked_at"] > GENERATION_CHECK_INTERVAL:
+        generation, lsn = await client.mget(GENERATION_KEY, GENERATION_LSN_KEY)
+        remember_generation(int(generation or 0), lsn)
+    return known_generation["value"]
+
+
+def cache_stats():
+    """Счетчики попаданий и промахов по уровням кеша."""
+    return {
+        "l1": {**stats["l1"], "size": len(local_cache.items)},
+        "redis": dict(stats["redis"]),
+        "generation": known_generation["value"],
+    }
+
+
+async def cache_set(key, value):
+    """
+    Записывает значение в кеш с CACHE_TTL и вытесняет лишние ключи.
+    """
+    now = time()
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.set(key, value, ex=CACHE_TTL)
+        pipe.zadd(INDEX_KEY, {key: now})
+        # Ключи, истекшие по TTL, убираем из индекса
+        pipe.zremrangebyscore(INDEX_KEY, "-inf", now - CACHE_TTL)
+        pipe.zcard(INDEX_KEY)
+        *_, count_keys = await pipe.execute()
+
+    excess = count_keys - CACHE_MAX_KEYS
+    if excess > 0:
+        oldest = await client.zrange(INDEX_KEY, 0, excess - 1)
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.delete(*oldest)
+            pipe.zrem(INDEX_KEY, *oldest)
+            await pipe.execute()
+
+
+def pack(generation, payload):
+    """Склеивает поколение данных и ответ в значение кеша."""
+    return b"%d\n" % generation + payload
+
+
+def unpack(value):
+    """Разбирает значение кеша на (поколение, ответ)."""
+    generation, _, payload = value.partition(b"\n")
+    return int(generation), payload
+
+
+async def refresh(key, loader, generation):
+    """
+    Выполняет запрос отдельной сессией БД и сохраняет результат в кеш.
+
+    Запись кладется в кеш под текущим поколением, поэтому запрос идет в реплику,
+    только если она уже применила WAL до позиции, записанной загрузчиком вместе
+    с поколением; иначе - в основную базу (см. database.fill_session). Так
+    отстающая реплика не закрепит в кеше строки до загрузки бюллетеня.
+    """
+    session_factory = await fill_session(known_generation["lsn"])
+    async with session_factory() as db:
+        payload = await loader(db)
+    if CACHE_COMPRESS and len(payload) >= CACHE_COMPRESS_MIN_SIZE:
+        payload = await asyncio.to_thread(gzip.compress, payload, 5)
+    await cache_set(key, pack(generation, payload))
+    local_cache.set(key, generation, payload)
+    return payload
+
+
+async def release_lock(lock_key, token):
+    """Снимает блокировку, только если она все еще принадлежит этому процессу."""
+    await client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+
+
+async def wait_for_entry(key, generation):
+    """
+    Ждет, пока другой процесс положит в кеш запись нужного поколения.
+
+    Возвращает:
+    - ответ или None, если запись не появилась за CACHE_LOCK_TIMEOUT.
+    """
+    deadline = time() + CACHE_LOCK_TIMEOUT
+    while time() < deadline:
+        await asyncio.sleep(CACHE_LOCK_POLL_INTERVAL)
+        value = await client.get(key)
+        if value is not None:
+            cached_generation, payload = unpack(value)
+            if cached_generation >= generation:
+                return payload
+    return None
+
+
+async def load_locked(key, loader, generation):
+    """
+    Выполняет запрос под блокировкой Redis (если CACHE_LOCK), чтобы при нескольких
+    воркерах uvicorn в базу ходил только один из них.
+    """
+    if not CACHE_LOCK:
+        return await refresh(key, loader, generation)
+
+    lock_key = f"{key}:lock"
+    token = uuid4().hex
+    acquired = await client.set(
+        lock_key, token, nx=True, px=int(CACHE_LOCK_TIMEOUT * 1000)
+    )
+    if acquired:
+        try:
+            return await refresh(key, loader, generation)
+        finally:
+            await release_lock(lock_key, token)
+
+    payload = await wait_for_entry(key, generation)
+    if payload is not None:
+        return payload
+    # Владелец блокировки не успел: выполняем запрос сами
+    return await refresh(key, loader, generation)
+
+
+def load_once(key, loader, generation):
+    """
+    Запускает загрузку ключа, если она еще не идет (single-flight).
+
+    Все одновременные запросы с одним ключом ждут одну и ту же задачу, поэтому в
+    базу уходит один запрос. Задачи различаются и по поколению: запрос после
+    загрузки бюллетеня не присоединяется к загрузке прошлого поколения, результат
+    которой лег бы в кеш устаревшим. Задача не привязана к HTTP-запросу, который
+    ее запустил, и не отменяется при его обрыве.
+
+    Возвращает:
+    - задачу, результатом которой будет ответ в bytes.
+    """
+    flight = (key, generation)
+    task = inflight.get(flight)
+    if task is None:
+        task = asyncio.create_task(load_locked(key, loader, generation))
+        inflight[flight] = task
+
+        def done(task):
+            inflight.pop(flight, None)
+            if not task.cancelled() and task.exception():
+                logging.error(f"Не удалось обновить кеш {key}: {task.exception()}")
+
+        task.add_done_callback(done)
+    return task
+
+
+async def cached(key, loader):
+    """
+    Возвращает готовый ответ из кеша, сверяя его с поколением данных.
+
+    - Сначала проверяется локальный кеш процесса (без обращения к сети).
+    - Запись Redis текущего поколения отдается сразу и кладется в локальный кеш.
+    - Запись прошлого поколения (загружен новый бюллетень) тоже отдается сразу,
+      а обновление запускается в фоне (stale-while-revalidate).
+    - При промахе запрос выполняется один раз на ключ, сколько бы одинаковых
+      запросов ни пришло одновременно, и результат кешируется.
+
+    Параметры:
+    - key: ключ кеша (см. make_key).
+    - loader: корутина loader(db), возвращающая ответ в bytes.
+    """
+    payload = local_cache.get(key, await current_generation())
+    if payload is not None:
+        stats["l1"]["hits"] += 1
+        return payload
+    stats["l1"]["misses"] += 1
+
+    generation, value = await cache_get(key)
+    if value is None:
+        stats["redis"]["misses"] += 1
+        return await asyncio.shield(load_once(key, loader, generation))
+    stats["redis"]["hits"] += 1
+
+    cached_generation, payload = unpack(value)
+    if cached_generation == generation:
+        local_cache.set(key, generation, payload)
+    else:
+        stats["redis"]["stale"] += 1
+        load_once(key, loader, generation)
+    return payload
+
+
+async def single_flight_demo(concurrency=500):
+    """
+    Показывает, что одновременные одинаковые запросы к cached() выполняют один
+    запрос к базе: concurrency вызовов с одним новым ключом ждут одну загрузку.
+    Нужны запущенные Redis и PostgreSQL.
+    """
+    calls = Counter()
+
+    async def loader(db):
+        calls["loader"] += 1
+        # Запрос к базе длится заметное время, чтобы все вызовы успели его застать
+        await db.execute(text("SELECT pg_sleep(0.2)"))
+        return b"[]"
+
+    key = make_key("single_flight_demo", run=uuid4().hex)
+    t0 = time()
+    try:
+        payloads = await asyncio.gather(
+            *(cached(key, loader) for _ in range(concurrency))
+        )
+        await client.delete(key)
+        await client.zrem(INDEX_KEY, key)
+    finally:
+        await close_redis()
+    print(
+        f"Вызовов cached(): {len(payloads)}, запросов к базе: {calls['loader']}, "
+        f"{time() - t0:.2f} c"
+    )
+    assert calls["loader"] == 1, "одинаковые запросы выполнили несколько загрузок"
+    assert all(payload == b"[]" for payload in payloads)
+
+
+if __name__ == "__main__":
+    # Пример: python -m app.cache
+    asyncio.run(single_flight_demo())
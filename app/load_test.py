@@ -0,0 +1,80 @@
+import argparse
+import asyncio
+import os
+from time import perf_counter
+
+import aiohttp
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Адрес запущенного API и запросы, которые повторяет нагрузочный тест
+LOAD_TEST_URL = os.getenv("LOAD_TEST_URL", "http://127.0.0.1:8000")
+LOAD_TEST_PATHS = (
+    "/last_dates",
+    "/get_dynamics?start_date=2024-01-01&end_date=2024-03-01",
+    "/get_trading_results?limit_trades=10",
+    # Потоковые ответы не кешируются и каждый раз берут соединение из пула
+    "/get_dynamics?start_date=2024-01-01&end_date=2024-01-10&format=ndjson",
+)
+
+
+def percentile(values, share):
+    """Значение, ниже которого лежит доля share отсортированных values."""
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+async def worker(session, url, paths, count, latencies, errors):
+    for i in range(count):
+        t0 = perf_counter()
+        try:
+            async with session.get(url + paths[i % len(paths)]) as response:
+                await response.read()
+                if response.status != 200:
+                    errors.append(response.status)
+        except aiohttp.ClientError as e:
+            errors.append(repr(e))
+        latencies.append(perf_counter() - t0)
+
+
+async def load_test(url, concurrency, requests, paths=LOAD_TEST_PATHS):
+    """
+    Отправляет requests запросов к API с concurrency одновременными клиентами
+    и печатает задержки и пропускную способность. Размер пула БД задается
+    сервером (DB_POOL_SIZE, DB_MAX_OVERFLOW); после прогона печатается
+    состояние пула из /pool_stats.
+    """
+    latencies = []
+    errors = []
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        t0 = perf_counter()
+        await asyncio.gather(
+            *(
+                worker(
+                    session, url, paths, requests // concurrency, latencies, errors
+                )
+                for _ in range(concurrency)
+            )
+        )
+        elapsed = perf_counter() - t0
+        async with session.get(url + "/pool_stats") as response:
+            stats = await response.json()
+
+    latencies.sort()
+    print(f"Запросов: {len(latencies)}, ошибок: {len(errors)}, {elapsed:.2f} c")
+    print(f"Пропускная способность: {len(latencies) / elapsed:.0f} запросов/с")
+    for name, share in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        print(f"{name}: {percentile(latencies, share) * 1000:.1f} мс")
+    print(f"Пул БД: {stats}")
+
+
+if __name__ == "__main__":
+    # Пример: DB_POOL_SIZE=5 uvicorn app.main:app --workers 4, затем
+    # python -m app.load_test --concurrency 64 --requests 5000
+    parser = argparse.ArgumentParser(description="Нагрузочный тест API")
+    parser.add_argument("--url", default=LOAD_TEST_URL)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(load_test(args.url, args.concurrency, args.requests))
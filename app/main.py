@@ -1,8 +1,23 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 
+from app.cache import check_redis, close_redis
 from app.routers import router
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Проверяет Redis при старте и закрывает пул соединений при остановке.
+    """
+    await check_redis()
+    yield
+    await close_redis()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.include_router(router)
 
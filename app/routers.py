@@ -1,194 +1,350 @@
-import json
-from parser.async_download.db_depends import get_async_db
-from parser.async_download.models import Data
+from parser.async_download.database import pool_stats, read_session
+from parser.models import DailyRollup, Data, Instrument, TradingDay
+from typing import Literal
 
-import redis
-from fastapi import APIRouter, Depends, Query
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Date, DateTime, cast, func, select, true, tuple_
 
-from app.schemas import Dates, Trades
-from app.utils import decimal_default, is_after_1411, to_dict
+from app.cache import cache_stats, cached, make_key
+from app.schemas import Dates, DynamicsPoint, Trades, TradesPage
+from app.utils import (TRADE_FIELDS, decode_cursor, json_response, rounded,
+                       serialize_dates, serialize_dynamics, serialize_page,
+                       serialize_trades, stream_rows)
 
 router = APIRouter()
 
-client = redis.Redis(host="localhost", port=6379, db=0)
+MAX_PAGE_SIZE = 10000
+
+
+# Проекция сделок под схему Trades: числа округляются на стороне БД
+TRADE_COLUMNS = (
+    Data.exchange_product_id,
+    Data.exchange_product_name,
+    Data.delivery_basis_name,
+    rounded(Data.volume),
+    rounded(Data.total),
+    rounded(Data.count),
+)
+
+
+def attribute_filters(model, oil_id, delivery_type_id, delivery_basis_id):
+    """
+    Собирает условия фильтрации по виду нефти, типу и базису поставки
+    для таблицы сделок или дневных итогов.
+    """
+    list_filters = []
+    if oil_id:
+        list_filters.append(model.oil_id == oil_id)
+    if delivery_type_id:
+        list_filters.append(model.delivery_type_id == delivery_type_id)
+    if delivery_basis_id:
+        list_filters.append(model.delivery_basis_id == delivery_basis_id)
+    return list_filters
+
+
+def query_loader(query, serialize):
+    """
+    Возвращает загрузчик для кеша: выполняет запрос и сериализует готовый ответ.
+    Загрузчик получает собственную сессию БД (см. app.cache.refresh).
+
+    Параметры:
+    - query: запрос SQLAlchemy.
+    - serialize: функция, превращающая строки результата в байты ответа.
+    """
+
+    async def loader(db):
+        results = await db.execute(query)
+        return serialize(results.all())
+
+    return loader
+
+
+@router.get("/cache_stats")
+async def get_cache_stats():
+    """
+    Возвращает счетчики попаданий и промахов локального кеша и Redis.
+    """
+    return cache_stats()
+
+
+@router.get("/pool_stats")
+async def get_pool_stats():
+    """
+    Возвращает состояние пулов соединений с основной базой и репликой: занятые и
+    свободные соединения, соединения сверх pool_size, время ожидания соединения
+    и отставание реплики.
+    """
+    return pool_stats()
 
 
 @router.get("/last_dates", response_model=list[Dates])
-async def get_last_trading_dates(
-    limit_days: int = 10, db: AsyncSession = Depends(get_async_db)
-):
+async def get_last_trading_dates(request: Request, limit_days: int = 10):
     """
     Получает последние уникальные даты торгов за указанное количество записей.
+    Даты берутся из таблицы trading_days, которую ведет загрузчик.
 
     Параметры:
     - limit_days: Количество последних дат, которые нужно получить (по умолчанию 10).
-    - db: Асинхронная сессия базы данных, внедряемая через Depends.
 
     Возвращает:
     - Список дат в порядке убывания.
     """
-    if is_after_1411():
-        query = (
-            select(Data.date).distinct().order_by(Data.date.desc()).limit(limit_days)
-        )
-        result = await db.scalars(query)
-        list_dates = result.all()
+    query = select(TradingDay.date).order_by(TradingDay.date.desc()).limit(limit_days)
+    key = make_key("last_dates", limit_days=limit_days)
+    payload = await cached(key, query_loader(query, serialize_dates))
+    return json_response(payload, request.headers.get("accept-encoding", ""))
 
-        # Преобразуем datetime в строку ISO
-        list_dates_str = [date.isoformat() for date in list_dates]
 
-        # Сохраняем в кеш
-        client.delete("last_trading_dates")
-        data_dicts = [to_dict(item) for item in list_dates_str]
-        data_json = json.dumps(data_dicts)
-        client.set("last_trading_dates", data_json)
-
-    else:
-        list_dates_bytes = client.get("last_trading_dates")
-        list_dates_json = list_dates_bytes.decode("utf-8")
-        list_dates_str = json.loads(list_dates_json)
-
-    # Объединяем оба варианта: строки с ISO датами
-    return [Dates(date=d) for d in list_dates_str]
+async def get_dynamics_rollup(
+    request,
+    granularity,
+    start_date,
+    end_date,
+    oil_id,
+    delivery_type_id,
+    delivery_basis_id,
+):
+    """
+    Итоги торгов по периодам из таблицы дневных итогов: суммы объема, оборота и
+    числа договоров по виду нефти, базису и типу поставки. instruments - число
+    инструментов за день, для недели и месяца - наибольшее за день периода.
+    """
+    # date приводится к timestamp явно: иначе PostgreSQL выберет date_trunc для
+    # timestamptz, и границы недель и месяцев зависели бы от часового пояса сессии
+    period = cast(
+        func.date_trunc(granularity, cast(DailyRollup.date, DateTime)), Date
+    ).label("period")
+    group = (
+        period,
+        DailyRollup.oil_id,
+        DailyRollup.delivery_basis_id,
+        DailyRollup.delivery_type_id,
+    )
+    query = (
+        select(
+            *group,
+            rounded(func.sum(DailyRollup.volume), "volume"),
+            rounded(func.sum(DailyRollup.total), "total"),
+            rounded(func.sum(DailyRollup.count), "count"),
+            func.max(DailyRollup.instruments).label("instruments"),
+        )
+        .where(
+            DailyRollup.date >= start_date,
+            DailyRollup.date <= end_date,
+            *attribute_filters(
+                DailyRollup, oil_id, delivery_type_id, delivery_basis_id
+            ),
+        )
+        .group_by(*group)
+        .order_by(*group)
+    )
+    key = make_key(
+        "dynamics_rollup",
+        granularity=granularity,
+        start_date=start_date,
+        end_date=end_date,
+        oil_id=oil_id,
+        delivery_type_id=delivery_type_id,
+        delivery_basis_id=delivery_basis_id,
+    )
+    payload = await cached(key, query_loader(query, serialize_dynamics))
+    return json_response(payload, request.headers.get("accept-encoding", ""))
 
 
-@router.get("/get_dynamics", response_model=list[Trades])
+@router.get(
+    "/get_dynamics", response_model=list[Trades] | TradesPage | list[DynamicsPoint]
+)
 async def get_dynamics(
-    start_date: Dates = Query(description="Дата начала", default="2025-01-01"),
-    end_date: Dates = Query(description="Дата окончания", default="2025-12-01"),
-    oil_id: int | None = Query(None, description="ID вида нефти для фильтрации"),
-    delivery_type_id: int | None = Query(None, description="ID типа поставки"),
-    delivery_basis_id: int | None = Query(None, description="ID основы доставки"),
-    db: AsyncSession = Depends(get_async_db),
+    request: Request,
+    start_date: str = Query(description="Дата начала", default="2025-01-01"),
+    end_date: str = Query(description="Дата окончания", default="2025-12-01"),
+    oil_id: str | None = Query(None, description="ID вида нефти для фильтрации"),
+    delivery_type_id: str | None = Query(None, description="ID типа поставки"),
+    delivery_basis_id: str | None = Query(None, description="ID основы доставки"),
+    page_size: int | None = Query(
+        None, ge=1, le=MAX_PAGE_SIZE, description="Размер страницы"
+    ),
+    cursor: str | None = Query(None, description="Курсор следующей страницы"),
+    output_format: Literal["json", "ndjson", "csv"] = Query(
+        "json", alias="format", description="Формат ответа"
+    ),
+    granularity: Literal["day", "week", "month"] | None = Query(
+        None, description="Агрегировать по дням, неделям или месяцам"
+    ),
 ):
     """
     Получает динамику данных за указанный диапазон дат с возможностью фильтрации.
 
     Параметры:
-    - start_date (date): Начальная дата диапазона (в форматах "YYYY.MM.DD", "DD.MM.YYYY",
+    - start_date (str): Начальная дата диапазона (в форматах "YYYY.MM.DD", "DD.MM.YYYY",
     "YYYY-MM-DD" или "DD-MM-YYYY").
-    - end_date (date): Конечная дата диапазона (в форматах "YYYY.MM.DD", "DD.MM.YYYY", "YYYY-MM-DD" или "DD-MM-YYYY").
-    - oil_id (int | None): ID вида нефти для фильтрации.
-    - delivery_type_id (int | None): ID типа поставки.
-    - delivery_basis_id (int | None): ID основы доставки.
-    - db (AsyncSession): Сессия БД.
+    - end_date (str): Конечная дата диапазона (в форматах "YYYY.MM.DD", "DD.MM.YYYY", "YYYY-MM-DD" или "DD-MM-YYYY").
+    - oil_id (str | None): ID вида нефти для фильтрации (первые 4 символа кода инструмента, например "A001").
+    - delivery_type_id (str | None): ID типа поставки (последний символ кода, например "F").
+    - delivery_basis_id (str | None): ID основы доставки (символы 5-7 кода).
+    - page_size (int | None): Размер страницы. Если задан, ответ - страница
+    {"items": [...], "next_cursor": ...}, строки упорядочены по (date, id).
+    - cursor (str | None): Курсор из next_cursor предыдущей страницы. Для
+    format=json требует page_size.
+    - format: "json" (по умолчанию), "ndjson" или "csv". ndjson и csv отдаются
+    потоково, без буферизации всего результата.
+    - granularity: "day", "week" или "month". Если задан, вместо сделок
+    возвращаются итоги по периодам (см. get_dynamics_rollup); page_size, cursor
+    и format при этом не используются.
 
     Результат:
     возвращает торги, удовлетворяющие условиям
     """
 
-    # start_date = parse_flexible_date(start_date)
-    # end_date = parse_flexible_date(end_date)
+    # Даты в нескольких форматах разбирает Dates; некорректная дата - ответ 400
+    start_date = Dates(date=start_date).date
+    end_date = Dates(date=end_date).date
 
-    list_filters = [Data.date >= start_date, Data.date <= end_date]
+    if granularity:
+        return await get_dynamics_rollup(
+            request,
+            granularity,
+            start_date,
+            end_date,
+            oil_id,
+            delivery_type_id,
+            delivery_basis_id,
+        )
 
-    if oil_id:
-        list_filters.append(Data.oil_id == oil_id)
-    if delivery_type_id:
-        list_filters.append(Data.delivery_type_id == delivery_type_id)
-    if delivery_basis_id:
-        list_filters.append(Data.delivery_basis_id == delivery_basis_id)
+    list_filters = [
+        Data.date >= start_date,
+        Data.date <= end_date,
+        *attribute_filters(Data, oil_id, delivery_type_id, delivery_basis_id),
+    ]
 
-        # if is_after_1411():
-        query = select(Data).where(*list_filters)
-        results = await db.scalars(query)
-        datas_str = results.all()
+    if cursor and not page_size and output_format == "json":
+        # Без page_size ответ кешируется по диапазону дат, курсор в ключ не входит
+        raise HTTPException(
+            status_code=400, detail="Параметр cursor используется вместе с page_size"
+        )
 
-        client.delete("dynamics")
-        data_dicts = [to_dict(item) for item in datas_str]
-        data_json = json.dumps(data_dicts, default=decimal_default)
-        client.set("dynamics", data_json)
+    if cursor:
+        # Keyset-пагинация: строки строго после последней строки прошлой страницы
+        after = tuple_(*decode_cursor(cursor))
+        list_filters.append(tuple_(Data.date, Data.id) > after)
 
-    else:
-        datas_bytes = client.get("dynamics")
-        datas_json = datas_bytes.decode("utf-8")
-        datas_str = json.loads(datas_json)
-        datas_str = to_dict(datas_str)
-
-    return [
-        Trades(
-            id=item.get("id"),
-            exchange_product_id=item.get("exchange_product_id"),
-            exchange_product_name=item.get("exchange_product_name"),
-            delivery_basis_name=item.get("delivery_basis_name"),
-            volume=round(float(item.get("volume")), 2),
-            total=round(float(item.get("total")), 2),
-            count=round(float(item.get("count")), 2),
+    if output_format != "json":
+        query = (
+            select(*TRADE_COLUMNS)
+            .where(*list_filters)
+            .order_by(Data.date, Data.id)
+        )
+        media_type = "text/csv" if output_format == "csv" else "application/x-ndjson"
+        return StreamingResponse(
+            stream_rows(await read_session(), query, output_format),
+            media_type=media_type,
         )
-        for item in datas_str
-        if item.get("exchange_product_id")
-        and item.get("exchange_product_name")
-        and item.get("delivery_basis_name")
-        and item.get("volume")
-        and item.get("total")
-        and item.get("count")
-    ]
+
+    if page_size:
+        query = (
+            select(*TRADE_COLUMNS, Data.date, Data.id)
+            .where(*list_filters)
+            .order_by(Data.date, Data.id)
+            .limit(page_size + 1)
+        )
+        key = make_key(
+            "dynamics_page",
+            start_date=start_date,
+            end_date=end_date,
+            oil_id=oil_id,
+            delivery_type_id=delivery_type_id,
+            delivery_basis_id=delivery_basis_id,
+            page_size=page_size,
+            cursor=cursor,
+        )
+        payload = await cached(
+            key, query_loader(query, lambda rows: serialize_page(rows, page_size))
+        )
+        return json_response(payload, request.headers.get("accept-encoding", ""))
+
+    query = select(*TRADE_COLUMNS).where(*list_filters)
+    key = make_key(
+        "dynamics",
+        start_date=start_date,
+        end_date=end_date,
+        oil_id=oil_id,
+        delivery_type_id=delivery_type_id,
+        delivery_basis_id=delivery_basis_id,
+    )
+    payload = await cached(key, query_loader(query, serialize_trades))
+    return json_response(payload, request.headers.get("accept-encoding", ""))
 
 
 @router.get("/get_trading_results", response_model=list[Trades])
 async def get_trading_results(
+    request: Request,
     limit_trades: int = Query(10, description="Количество последних операций"),
-    oil_id: int | None = Query(None, description="ID вида нефти для фильтрации"),
-    delivery_type_id: int | None = Query(None, description="ID типа поставки"),
-    delivery_basis_id: int | None = Query(None, description="ID основы доставки"),
-    db: AsyncSession = Depends(get_async_db),
+    oil_id: str | None = Query(None, description="ID вида нефти для фильтрации"),
+    delivery_type_id: str | None = Query(None, description="ID типа поставки"),
+    delivery_basis_id: str | None = Query(None, description="ID основы доставки"),
+    mode: Literal["latest", "per_instrument"] = Query(
+        "latest", description="latest - последние сделки, per_instrument - "
+        "последняя сделка по каждому инструменту"
+    ),
 ):
     """
     Получает последние операции трейдинга с возможностью фильтрации и ограничением.
-    Также пересохраняет результаты в Redis, если время после 14:11.
+    Результаты кешируются в Redis до загрузки нового бюллетеня.
 
     Параметры:
     - limit_trades: Максимальное число операций (по умолчанию 10).
     - oil_id: ID вида нефти для фильтрации (опционально).
     - delivery_type_id: ID типа поставки (опционально).
     - delivery_basis_id: ID основы доставки (опционально).
-    - db: Асинхронная сессия базы данных, внедряемая через Depends.
+    - mode: "latest" - последние операции по (date, id); "per_instrument" -
+    последняя операция по каждому инструменту справочника instruments,
+    самые свежие первыми.
 
     Возвращает:
     - список объектов Data.
     """
-    # Формируем фильтры
-    list_filters = []
-    if oil_id:
-        list_filters.append(Data.oil_id == oil_id)
-    if delivery_type_id:
-        list_filters.append(Data.delivery_type_id == delivery_type_id)
-    if delivery_basis_id:
-        list_filters.append(Data.delivery_basis_id == delivery_basis_id)
-
-    if is_after_1411():
-        query = select(Data).where(*list_filters).limit(limit_trades)
-        results = await db.scalars(query)
-        data_list = results.all()
-
-        client.delete("trading_results")
-        data_dicts = [to_dict(item) for item in data_list]
-        data_json = json.dumps(data_dicts, default=decimal_default)
-        client.set("trading_results", data_json)
-
+    latest_first = (Data.date.desc(), Data.id.desc())
+    if mode == "per_instrument":
+        # Для каждого инструмента справочника одна проба индекса
+        # (exchange_product_id, date DESC, id DESC) вместо чтения всей истории
+        latest = (
+            select(*TRADE_COLUMNS, Data.date, Data.id)
+            .where(Data.exchange_product_id == Instrument.exchange_product_id)
+            .order_by(*latest_first)
+            .limit(1)
+            .lateral("latest")
+        )
+        query = (
+            select(*(latest.c[name] for name in TRADE_FIELDS))
+            .select_from(Instrument)
+            .join(latest, true())
+            .where(
+                *attribute_filters(
+                    Instrument, oil_id, delivery_type_id, delivery_basis_id
+                )
+            )
+            .order_by(latest.c.date.desc(), latest.c.id.desc())
+            .limit(limit_trades)
+        )
     else:
-        data_list_bytes = client.get("trading_results")
-        data_list_json = data_list_bytes.decode("utf-8")
-        data_list = json.loads(data_list_json)
-        data_list = to_dict(data_list)
-
-    return [
-        Trades(
-            id=item.get("id"),
-            exchange_product_id=item.get("exchange_product_id"),
-            exchange_product_name=item.get("exchange_product_name"),
-            delivery_basis_name=item.get("delivery_basis_name"),
-            volume=round(float(item.get("volume")), 2),
-            total=round(float(item.get("total")), 2),
-            count=round(float(item.get("count")), 2),
+        list_filters = attribute_filters(
+            Data, oil_id, delivery_type_id, delivery_basis_id
         )
-        for item in data_list
-        if item.get("exchange_product_id")
-        and item.get("exchange_product_name")
-        and item.get("delivery_basis_name")
-        and item.get("volume")
-        and item.get("total")
-        and item.get("count")
-    ]
+        # Обратный проход по индексу с ключом (..., date, id): top-N без сортировки
+        query = (
+            select(*TRADE_COLUMNS)
+            .where(*list_filters)
+            .order_by(*latest_first)
+            .limit(limit_trades)
+        )
+    key = make_key(
+        "trading_results",
+        mode=mode,
+        limit_trades=limit_trades,
+        oil_id=oil_id,
+        delivery_type_id=delivery_type_id,
+        delivery_basis_id=delivery_basis_id,
+    )
+    payload = await cached(key, query_loader(query, serialize_trades))
+    return json_response(payload, request.headers.get("accept-encoding", ""))
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import date, datetime
 
 from fastapi import HTTPException
 from pydantic import BaseModel, field_validator
@@ -28,3 +28,19 @@ class Trades(BaseModel):
     volume: float
     total: float
     count: float
+
+
+class TradesPage(BaseModel):
+    items: list[Trades]
+    next_cursor: str | None
+
+
+class DynamicsPoint(BaseModel):
+    period: date
+    oil_id: str
+    delivery_basis_id: str
+    delivery_type_id: str
+    volume: float
+    total: float
+    count: float
+    instruments: int
@@ -1,31 +1,196 @@
-from datetime import date, datetime
+import base64
+import csv
+import gzip
+import io
+import json
+from datetime import date
 from decimal import Decimal
+from time import time
 
+import orjson
+from fastapi import HTTPException, Response
+from sqlalchemy import Float, cast, func
 
-def is_after_1411():
+# Поля ответа со сделками в порядке схемы Trades
+TRADE_FIELDS = (
+    "exchange_product_id",
+    "exchange_product_name",
+    "delivery_basis_name",
+    "volume",
+    "total",
+    "count",
+)
+
+# Поля агрегированной динамики в порядке схемы DynamicsPoint
+DYNAMICS_FIELDS = (
+    "period",
+    "oil_id",
+    "delivery_basis_id",
+    "delivery_type_id",
+    "volume",
+    "total",
+    "count",
+    "instruments",
+)
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def rounded(column, name=None):
+    """
+    Округляет числовую колонку до двух знаков на стороне БД и отдает ее как float,
+    чтобы ответ не проходил через Decimal. name - имя колонки результата
+    (по умолчанию имя исходной колонки).
     """
-    Проверяет, после ли 14:11 текущего дня.
+    return cast(func.round(column, 2), Float).label(name or column.name)
 
-    Возвращает:
-    - True, если время позже 14:11.
-    - False в противном случае.
+
+def serialize_dates(rows):
+    """Сериализует строки (date,) в готовый ответ /last_dates."""
+    return orjson.dumps([{"date": row[0]} for row in rows])
+
+
+def serialize_trades(rows):
+    """
+    Сериализует строки в порядке TRADE_FIELDS в готовый ответ со сделками
+    за один проход, пропуская неполные записи.
+    """
+    return orjson.dumps([dict(zip(TRADE_FIELDS, row)) for row in rows if all(row)])
+
+
+def serialize_dynamics(rows):
+    """Сериализует строки в порядке DYNAMICS_FIELDS в ответ агрегированной динамики."""
+    return orjson.dumps([dict(zip(DYNAMICS_FIELDS, row)) for row in rows])
+
+
+def encode_cursor(row_date, row_id):
+    """Кодирует позицию (date, id) последней строки страницы в курсор."""
+    raw = f"{row_date.isoformat()}|{row_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Раскодирует курсор страницы в (date, id).
+    Некорректный курсор - ошибка 400.
     """
-    now = datetime.now()
-    return (now.hour > 14) or (now.hour == 14 and now.minute >= 11)
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        row_date, row_id = raw.split("|")
+        return date.fromisoformat(row_date), int(row_id)
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail=f"Некорректный курсор: {cursor}")
+
+
+def serialize_page(rows, page_size):
+    """
+    Сериализует страницу сделок. Строки - TRADE_FIELDS, затем date и id;
+    запрос выбирает page_size + 1 строк, чтобы узнать, есть ли следующая страница.
+    """
+    page = rows[:page_size]
+    next_cursor = encode_cursor(*page[-1][-2:]) if len(rows) > page_size else None
+    return orjson.dumps(
+        {
+            "items": [dict(zip(TRADE_FIELDS, row)) for row in page if all(row)],
+            "next_cursor": next_cursor,
+        }
+    )
+
+
+async def stream_rows(session_factory, query, output_format, chunk_size=1000):
+    """
+    Потоково отдает строки сделок в формате ndjson или csv.
+
+    Сессия открывается внутри генератора: зависимость FastAPI закрылась бы до
+    того, как ответ начнет отправляться. Строки читаются серверным курсором
+    пачками по chunk_size, поэтому в памяти не бывает больше одной пачки.
+    """
+    if output_format == "csv":
+        yield (",".join(TRADE_FIELDS) + "\n").encode("utf-8")
+
+    async with session_factory() as db:
+        result = await db.stream(query.execution_options(yield_per=chunk_size))
+        async for rows in result.partitions():
+            rows = [row[: len(TRADE_FIELDS)] for row in rows if all(row)]
+            if output_format == "csv":
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(rows)
+                yield buffer.getvalue().encode("utf-8")
+            else:
+                yield b"".join(
+                    orjson.dumps(dict(zip(TRADE_FIELDS, row))) + b"\n" for row in rows
+                )
+
+
+def json_response(payload, accept_encoding=""):
+    """
+    Отдает закешированный JSON как есть, без повторной валидации и сериализации.
+    Сжатый ответ отдается сжатым, если клиент принимает gzip, иначе распаковывается.
+    """
+    if payload[:2] != GZIP_MAGIC:
+        return Response(content=payload, media_type="application/json")
+    if "gzip" in accept_encoding:
+        return Response(
+            content=payload,
+            media_type="application/json",
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+        )
+    return Response(content=gzip.decompress(payload), media_type="application/json")
+
 
+if __name__ == "__main__":
+    # Замер сериализации 10 000 строк: прежний путь через json/Decimal/Trades
+    # против одного прохода orjson по уже округленным float.
+    from app.schemas import Trades
 
-def to_dict(instance):
-    if hasattr(instance, "__table__"):
-        return {
-            column.name: getattr(instance, column.name)
-            for column in instance.__table__.columns
+    count_rows = 10000
+    decimal_rows = [
+        {
+            "id": i,
+            "exchange_product_id": f"A{i:07d}",
+            "exchange_product_name": f"Инструмент {i}",
+            "delivery_basis_name": "Базис",
+            "volume": Decimal("123.45678900"),
+            "total": Decimal("987654.32100000"),
+            "count": Decimal("3.00000000"),
         }
-    elif isinstance(instance, (date, datetime)):
-        return instance.isoformat()
-    else:
-        return instance
+        for i in range(count_rows)
+    ]
+    float_rows = [
+        (
+            row["exchange_product_id"],
+            row["exchange_product_name"],
+            row["delivery_basis_name"],
+            123.46,
+            987654.32,
+            3.0,
+        )
+        for row in decimal_rows
+    ]
 
+    def legacy():
+        cached = json.dumps(decimal_rows, default=str)
+        items = json.loads(cached)
+        trades = [
+            Trades(
+                **{
+                    field: (
+                        round(float(item[field]), 2)
+                        if field in ("volume", "total", "count")
+                        else item[field]
+                    )
+                    for field in TRADE_FIELDS
+                }
+            )
+            for item in items
+        ]
+        return json.dumps([trade.model_dump() for trade in trades]).encode("utf-8")
 
-def decimal_default(obj):
-    if isinstance(obj, Decimal):
-        return str(obj)
+    for name, serialize in (
+        ("json + Trades", legacy),
+        ("orjson", lambda: serialize_trades(float_rows)),
+    ):
+        t0 = time()
+        for _ in range(10):
+            serialize()
+        print(f"{name}: {(time() - t0) / 10 * 1000:.1f} мс на {count_rows} строк")
@@ -0,0 +1,123 @@
+from datetime import datetime
+from parser.models import DailyRollup, Data, Instrument, TradingDay
+
+from sqlalchemy import DateTime, delete, exists, func, insert, literal, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+# Запросы пересчета производных таблиц (trading_days, trading_daily_rollups и
+# справочника instruments) по датам загруженной пачки. Общие для асинхронного и
+# синхронного загрузчиков: оба выполняют их в транзакции записи строк.
+
+
+def trading_days_statements(dates):
+    """
+    Пересчитывает строки trading_days для дат пачки по таблице сделок.
+    Пересчет, а не прибавление, сохраняет итоги верными при повторной загрузке дня.
+    """
+    now = datetime.now()
+    totals = (
+        select(
+            Data.date,
+            func.count(),
+            func.sum(Data.volume),
+            literal(now, DateTime),
+        )
+        .where(Data.date.in_(dates))
+        .group_by(Data.date)
+    )
+    statement = pg_insert(TradingDay).from_select(
+        ["date", "row_count", "total_volume", "loaded_at"], totals
+    )
+    return [
+        statement.on_conflict_do_update(
+            index_elements=["date"],
+            set_={
+                name: statement.excluded[name]
+                for name in ("row_count", "total_volume", "loaded_at")
+            },
+        )
+    ]
+
+
+def daily_rollups_statements(dates):
+    """
+    Пересчитывает дневные итоги trading_daily_rollups для дат пачки.
+    Строки дат удаляются и собираются заново: так исчезают и группы, которых
+    после перезагрузки дня больше нет.
+    """
+    group = (Data.date, Data.oil_id, Data.delivery_basis_id, Data.delivery_type_id)
+    totals = (
+        select(
+            *group,
+            func.sum(Data.volume),
+            func.sum(Data.total),
+            func.sum(Data.count),
+            func.count(Data.exchange_product_id.distinct()),
+        )
+        .where(Data.date.in_(dates))
+        .group_by(*group)
+    )
+    return [
+        delete(DailyRollup).where(DailyRollup.date.in_(dates)),
+        insert(DailyRollup).from_select(
+            [
+                "date",
+                "oil_id",
+                "delivery_basis_id",
+                "delivery_type_id",
+                "volume",
+                "total",
+                "count",
+                "instruments",
+            ],
+            totals,
+        ),
+    ]
+
+
+def dimensions_statements(dates):
+    """
+    Добавляет в справочник instruments инструменты, встретившиеся в строках дат
+    пачки. Вставляются только новые записи: иначе каждая пачка расходовала бы
+    значения последовательности id.
+    """
+    instruments = (
+        select(
+            Data.exchange_product_id,
+            Data.exchange_product_name,
+            Data.oil_id,
+            Data.delivery_basis_id,
+            Data.delivery_type_id,
+        )
+        .distinct(Data.exchange_product_id)
+        .where(
+            Data.date.in_(dates),
+            ~exists().where(Instrument.exchange_product_id == Data.exchange_product_id),
+        )
+        .order_by(Data.exchange_product_id, Data.date.desc(), Data.id.desc())
+    )
+    return [
+        pg_insert(Instrument)
+        .from_select(
+            [
+                "exchange_product_id",
+                "exchange_product_name",
+                "oil_id",
+                "delivery_basis_id",
+                "delivery_type_id",
+            ],
+            instruments,
+        )
+        .on_conflict_do_nothing(),
+    ]
+
+
+def refresh_statements(dates):
+    """Все запросы пересчета производных таблиц для дат пачки, в порядке выполнения."""
+    if not dates:
+        return []
+    return (
+        trading_days_statements(dates)
+        + daily_rollups_statements(dates)
+        + dimensions_statements(dates)
+    )
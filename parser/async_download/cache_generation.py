@@ -0,0 +1,41 @@
+import logging
+import os
+
+from dotenv import load_dotenv
+from redis import asyncio as aioredis
+
+load_dotenv()
+
+# Номер поколения данных: увеличивается, когда в spimex_trading_results появляются
+# новые строки. Кеш API сверяет с ним свои записи.
+GENERATION_KEY = "spimex:generation"
+# Позиция WAL основной базы после загрузки строк поколения: кеш заполняется с
+# реплики, только когда она применила WAL до этой позиции
+GENERATION_LSN_KEY = "spimex:generation_lsn"
+
+
+async def bump_generation(lsn=None):
+    """
+    Увеличивает номер поколения данных, чтобы API обновил кеш, и записывает
+    позицию WAL основной базы lsn (pg_lsn в виде текста), на которой видны
+    строки поколения. Без lsn кеш нового поколения заполняется из основной базы.
+    Ошибка Redis не прерывает загрузку: кеш обновится при следующей загрузке.
+    """
+    client = aioredis.Redis(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", "6379")),
+        db=int(os.getenv("REDIS_DB", "0")),
+    )
+    try:
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.incr(GENERATION_KEY)
+            if lsn:
+                pipe.set(GENERATION_LSN_KEY, lsn)
+            else:
+                pipe.delete(GENERATION_LSN_KEY)
+            generation, _ = await pipe.execute()
+        logging.info(f"Поколение данных для кеша API: {generation}")
+    except Exception as e:
+        logging.error(f"Не удалось обновить поколение данных в Redis: {e}")
+    finally:
+        await client.aclose()
@@ -1,18 +1,32 @@
 import asyncio
+import base64
+import hashlib
+import json
 import logging
 import os
 import re
 from datetime import datetime
+from itertools import count
+from parser.http_client import async_get_with_retries, create_async_session
 from time import time
 
 import aiofiles
-import aiohttp
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 
 load_dotenv()
-semaphore = asyncio.Semaphore(100)
 END_YEAR = 2023
+# Сколько страниц со ссылками загружается одновременно
+PAGES_CONCURRENCY = int(os.getenv("PAGES_CONCURRENCY", "5"))
+# Сколько файлов одновременно скачивается с spimex.com
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "10"))
+semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+# Перепроверять ли уже скачанные файлы условными запросами
+REVALIDATE_FILES = os.getenv("REVALIDATE_FILES", "false").lower() == "true"
+CHUNK_SIZE = 64 * 1024
+# Незавершенная загрузка и сохраненные заголовки файла
+PART_SUFFIX = ".part"
+META_SUFFIX = ".meta"
 
 current_dir = os.path.dirname(__file__)
 log_file = os.path.join(current_dir, "..", "..", "logs", "parser_errors.log")
@@ -35,133 +49,258 @@ headers = {"Accept": st_accept, "User-Agent": st_useragent}
 
 base_url = os.getenv("OIL_TRADES_RESULTS_API_URL")
 
-stop_event = asyncio.Event()
-
 count_files = 0
+count_bytes = 0
+count_pages = 0
 
 
-async def try_request(session, url, headers, max_retries=3, delay=0):
-    """Попытка выполнить GET-запрос с несколькими повторными попытками."""
-    # async with semaphore:
-    for attempt in range(1, max_retries + 1):
-        try:
-            response = await session.get(url, headers=headers)
-            yield response
-            break
-        except aiohttp.ClientConnectionError as e:
-            print(
-                f"Ошибка соединения при запросе {url}: {e}. Попытка {attempt} из {max_retries}."
-            )
-            if attempt < max_retries:
-                if delay:
-                    await asyncio.sleep(delay)
-                print("Неудачно. Пробуем скачать файл еще раз.")
-                continue
-            else:
-                break
-        except aiohttp.ClientError as e:
-            print(f"Общая ошибка клиента при запросе {url}: {e}")
-            yield None
-
-
-async def process_link(session, link, headers, year):
+def link_date(link):
+    """Возвращает дату и время бюллетеня из ссылки или None."""
+    match = re.search(r"oil_xls_(\d{8})(\d{6})\.xls", link.get("href", ""))
+    if not match:
+        return None
+    try:
+        return datetime.strptime(match.group(1) + match.group(2), "%Y%m%d%H%M%S")
+    except ValueError:
+        return None
+
+
+def read_meta(file_path):
+    """Читает сохраненные ETag и Last-Modified файла (пустой словарь, если их нет)."""
+    try:
+        with open(file_path + META_SUFFIX, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_meta(file_path, response):
+    """Сохраняет ETag и Last-Modified ответа рядом с файлом."""
+    meta = {
+        header: response.headers[header]
+        for header in ("ETag", "Last-Modified")
+        if header in response.headers
+    }
+    if meta:
+        with open(file_path + META_SUFFIX, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+
+def check_download(response, size, md5):
+    """
+    Сверяет скачанное с Content-Length и Content-MD5 (если сервер их прислал).
+
+    Возвращает:
+    - описание расхождения или None.
+    """
+    # При сжатии Content-Length относится к сжатому телу, его не сверяем
+    compressed = "Content-Encoding" in response.headers
+    expected_size = response.content_length
+    if not compressed and expected_size is not None and expected_size != size:
+        return f"размер {size} вместо {expected_size} байт"
+    expected_md5 = response.headers.get("Content-MD5")
+    if expected_md5 and base64.b64decode(expected_md5) != md5.digest():
+        return "контрольная сумма не совпала"
+    return None
+
+
+async def save_response(response, file_path):
+    """
+    Потоково пишет тело ответа во временный файл и атомарно переименовывает его.
+
+    Возвращает:
+    - число записанных байт.
+    """
+    tmp_path = file_path + PART_SUFFIX
+    size = 0
+    md5 = hashlib.md5()
+    try:
+        async with aiofiles.open(tmp_path, "wb") as f:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                await f.write(chunk)
+                size += len(chunk)
+                md5.update(chunk)
+            await f.flush()
+            await asyncio.to_thread(os.fsync, f.fileno())
+
+        error = check_download(response, size, md5)
+        if error:
+            raise ValueError(f"Файл скачан не полностью: {error}")
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    write_meta(file_path, response)
+    return size
+
+
+async def process_link(session, link, headers, files_queue=None):
     """
-    Обрабатывает ссылку: скачивает файл, если он соответствует условиям.
+    Скачивает файл по ссылке, если его еще нет в директории.
+
+    Если включена перепроверка (REVALIDATE_FILES), уже скачанный файл
+    запрашивается условно (If-None-Match / If-Modified-Since) и скачивается
+    заново только при изменении на сервере.
+    Путь к скачанному файлу кладется в files_queue, если она передана.
     """
-    global count_files
+    global count_files, count_bytes
     href = link.get("href", "")
-    match = re.search(r"oil_xls_(\d{8})(\d{6})\.xls", href)
-
-    if match:
-        date_str = match.group(1)
-        time_str = match.group(2)
-        try:
-            date_obj = datetime.strptime(date_str + time_str, "%Y%m%d%H%M%S")
-            # if count_files == 50:
-            #     stop_event.set()
-            if date_obj.year >= year:
-                full_url = "https://spimex.com" + href
-                readable_date = date_obj.strftime("%Y-%m-%d_%H-%M-%S")
-                filename = f"oil_{readable_date}.xls"
-                file_path = os.path.join(data_dir, filename)
-
-                if os.path.exists(file_path):
-                    print(f"Файл уже существует: {file_path}")
-                    return
-
-                async for response_file in try_request(session, full_url, headers):
-                    if response_file and response_file.status == 200:
-                        content = await response_file.read()
-                        async with aiofiles.open(file_path, "wb") as f:
-                            await f.write(content)
-                        count_files += 1
-                        print(f"Файл сохранен: {file_path}, {count_files}")
-                    else:
-                        print(
-                            f"Ошибка скачивания файла: "
-                            f"{response_file.status if response_file else 'нет ответа'}"
-                        )
-            else:
-                logging.warning(f"Файл ранее {year} года, скачивание завершается")
-                stop_event.set()
+    date_obj = link_date(link)
+    try:
+        full_url = "https://spimex.com" + href
+        readable_date = date_obj.strftime("%Y-%m-%d_%H-%M-%S")
+        filename = f"oil_{readable_date}.xls"
+        file_path = os.path.join(data_dir, filename)
+
+        request_headers = headers
+        if os.path.exists(file_path):
+            meta = read_meta(file_path)
+            if not (REVALIDATE_FILES and meta):
+                print(f"Файл уже существует: {file_path}")
+                return
+            request_headers = dict(headers)
+            if "ETag" in meta:
+                request_headers["If-None-Match"] = meta["ETag"]
+            if "Last-Modified" in meta:
+                request_headers["If-Modified-Since"] = meta["Last-Modified"]
+
+        saved = False
+        async with semaphore:
+            response_file = await async_get_with_retries(
+                session, full_url, request_headers
+            )
+            if response_file is None:
+                print("Ошибка скачивания файла: нет ответа")
+                return
+            try:
+                if response_file.status == 304:
+                    print(f"Файл не изменился: {file_path}")
+                elif response_file.status == 200:
+                    size = await save_response(response_file, file_path)
+                    count_files += 1
+                    count_bytes += size
+                    saved = True
+                    print(f"Файл сохранен: {file_path}, {count_files}")
+                else:
+                    print(f"Ошибка скачивания файла: {response_file.status}")
+            finally:
+                response_file.release()
 
-        except Exception as e:
-            print(f"{e}")
+        if saved and files_queue is not None:
+            await files_queue.put(file_path)
+
+    except Exception as e:
+        print(f"Ошибка при обработке файла {href}: {e}")
+        logging.error(f"Ошибка при обработке файла {href}: {e}")
 
 
 async def load_page(session, page_number, headers):
     """
-    Загружает страницу и возвращает список ссылок.
+    Загружает страницу и возвращает список ссылок (None при ошибке).
     """
     url = f"{base_url}?page=page-{page_number}"
-    async for response in try_request(session, url, headers):
-        if response is None:
-            # ошибка, дальнейшие действия
-            continue
+    response = await async_get_with_retries(session, url, headers)
+    if response is None:
+        return None
+    try:
         if response.status != 200:
             print(
                 f"Ошибка доступа: статус {response.status}, ошибка {await response.text()}"
             )
-            continue
+            return None
         content = await response.text()
-        soup = BeautifulSoup(content, "html.parser")
-        links = soup.find_all("a", class_="accordeon-inner__item-title link xls")
-        yield links, response
+    finally:
+        response.release()
+    soup = BeautifulSoup(content, "html.parser")
+    return soup.find_all("a", class_="accordeon-inner__item-title link xls")
 
 
-async def load_file(year=2023):
+async def crawl_pages(session, year, download_tasks, files_queue=None):
     """
-    Основная функция для скачивания файлов за указанный год.
+    Обходит страницы со ссылками, загружая до PAGES_CONCURRENCY страниц одновременно.
+
+    Для каждой ссылки не старше year создается задача скачивания. Обход
+    прекращается на первой странице без ссылок, на странице, самый свежий
+    бюллетень которой старше year (дальше идут только более старые), или на
+    странице, которую не удалось загрузить. Страницы до нее обрабатываются,
+    даже если загрузились позже.
     """
-    page_number = 1
-    async with aiohttp.ClientSession() as session:
+    page_numbers = count(1)
+    # Номер страницы, на которой обход останавливается. Страницы с меньшими
+    # номерами, загруженные позже, по-прежнему обрабатываются
+    stop_page = {"number": float("inf")}
+
+    def stop_at(page_number):
+        stop_page["number"] = min(stop_page["number"], page_number)
+
+    async def worker():
+        global count_pages
         while True:
-            async for links, response in load_page(session, page_number, headers):
-                if stop_event.is_set():
-                    if response.closed:
-                        print("Соединение уже закрыто")
-                    return None
-                if not links:
-                    print(f"На странице {page_number} ссылок не найдено или ошибка.")
-                    response.release()
-                    break
-
-            tasks = []
-            count = 0
-            for link in links:
-                tasks.append(
-                    asyncio.create_task(process_link(session, link, headers, year))
+            page_number = next(page_numbers)
+            if page_number > stop_page["number"]:
+                return
+            links = await load_page(session, page_number, headers)
+            if page_number > stop_page["number"]:
+                return
+            if links is None:
+                logging.error(
+                    f"Страница {page_number} не загружена после повторов, "
+                    f"обход останавливается на ней"
+                )
+                stop_at(page_number)
+                return
+            if not links:
+                print(f"На странице {page_number} ссылок не найдено.")
+                logging.info(f"На странице {page_number} ссылок нет, обход завершается")
+                stop_at(page_number)
+                return
+            count_pages += 1
+
+            dated_links = [(link, link_date(link)) for link in links]
+            dated_links = [(link, date) for link, date in dated_links if date]
+            for link, date_obj in dated_links:
+                if date_obj.year >= year:
+                    download_tasks.append(
+                        asyncio.create_task(
+                            process_link(session, link, headers, files_queue)
+                        )
+                    )
+
+            if not dated_links or max(d for _, d in dated_links).year < year:
+                logging.warning(
+                    f"На странице {page_number} файлы ранее {year} года, обход завершается"
                 )
-                count += 1
-                if count == 10:
-                    break
-            if tasks:
-                await asyncio.gather(*tasks, return_exceptions=False)
-            page_number += 1
+                stop_at(page_number)
+
+    await asyncio.gather(*(worker() for _ in range(PAGES_CONCURRENCY)))
+
+
+async def load_file(year=2023, files_queue=None):
+    """
+    Основная функция для скачивания файлов начиная с указанного года.
+    """
+    t0 = time()
+    download_tasks = []
+    async with create_async_session(
+        limit_per_host=PAGES_CONCURRENCY + DOWNLOAD_CONCURRENCY
+    ) as session:
+        await crawl_pages(session, year, download_tasks, files_queue)
+        if download_tasks:
+            await asyncio.gather(*download_tasks)
+
+    elapsed = time() - t0
+    logging.info(
+        f"Обход завершен за {elapsed:.1f} c: страниц {count_pages}, "
+        f"ссылок {len(download_tasks)}, скачано файлов {count_files} "
+        f"({count_bytes / 1024 / 1024:.1f} МБ), "
+        f"{count_files / elapsed:.1f} файлов/с, "
+        f"{count_bytes / 1024 / 1024 / elapsed:.2f} МБ/с"
+    )
 
 
-async def main_load():
-    await load_file(END_YEAR)
+async def main_load(files_queue=None):
+    await load_file(END_YEAR, files_queue)
 
 
 if __name__ == "__main__":
@@ -1,19 +1,202 @@
+import logging
 import os
+from time import monotonic, perf_counter
 
 from dotenv import load_dotenv
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import (AsyncSession, async_sessionmaker,
                                     create_async_engine)
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_async_engine(DATABASE_URL, echo=False)
+# Реплика для GET-запросов API (если не задана, читается основная база)
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+# Пул соединений: постоянные соединения, сверх них при пиках, ожидание
+# свободного соединения (секунды) и время жизни соединения (секунды)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Проверять соединение перед выдачей из пула
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Сколько подготовленных запросов asyncpg хранит на одно соединение
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+# Отставание реплики (секунды), после которого чтение идет в основную базу,
+# и как часто отставание перепроверяется (секунды)
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", "1"))
+
+# Отставание реплики: время с последней примененной транзакции. Если реплика
+# применила весь полученный WAL, она не отстает, даже когда основная база давно
+# ничего не писала (между бюллетенями). На основной базе - 0.
+REPLICA_LAG_SQL = text(
+    "SELECT CASE "
+    "WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) "
+    "END"
+)
+
+
+# Текущая позиция WAL основной базы и позиция, до которой реплика применила WAL
+PRIMARY_LSN_SQL = text("SELECT pg_current_wal_lsn()::text")
+REPLICA_REPLAY_LSN_SQL = text("SELECT pg_last_wal_replay_lsn()::text")
+
+
+def parse_lsn(lsn):
+    """Переводит позицию WAL вида '16/B374D848' в число для сравнения."""
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) | int(low, 16)
+
+
+class TimedPool(AsyncAdaptedQueuePool):
+    """Пул соединений, который считает время ожидания свободного соединения."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Выдачи соединений из пула и время, которое они заняли (секунды)
+        self.waits = {"count": 0, "total": 0.0, "max": 0.0}
+
+    def _do_get(self):
+        t0 = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            elapsed = perf_counter() - t0
+            self.waits["count"] += 1
+            self.waits["total"] += elapsed
+            self.waits["max"] = max(self.waits["max"], elapsed)
+
+
+def make_engine(url):
+    """Создает async-движок с настройками пула из окружения."""
+    return create_async_engine(
+        url,
+        echo=False,
+        poolclass=TimedPool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args={"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE},
+    )
+
+
+engine = make_engine(DATABASE_URL)
+read_engine = make_engine(DATABASE_READ_URL) if DATABASE_READ_URL else engine
 
 async_session = async_sessionmaker(
     bind=engine, class_=AsyncSession, expire_on_commit=False
 )
+read_async_session = async_sessionmaker(
+    bind=read_engine, class_=AsyncSession, expire_on_commit=False
+)
+
+# replayed - наибольшая виденная позиция, до которой реплика применила WAL
+replica_state = {"checked_at": float("-inf"), "lag": 0.0, "replayed": 0}
+
+
+async def replica_lag():
+    """
+    Возвращает отставание реплики в секундах, перепроверяя его не чаще раза
+    в REPLICA_LAG_CHECK_INTERVAL. Недоступная реплика считается бесконечно отставшей.
+    """
+    now = monotonic()
+    if now - replica_state["checked_at"] >= REPLICA_LAG_CHECK_INTERVAL:
+        replica_state["checked_at"] = now
+        try:
+            async with read_engine.connect() as conn:
+                replica_state["lag"] = float(await conn.scalar(REPLICA_LAG_SQL))
+        except Exception as e:
+            logging.warning(f"Реплика недоступна: {e!r}")
+            replica_state["lag"] = float("inf")
+    return replica_state["lag"]
+
+
+async def read_session():
+    """
+    Выбирает фабрику сессий для чтения: реплику, если она настроена и отстает
+    не больше REPLICA_MAX_LAG секунд, иначе основную базу.
+    """
+    if read_engine is engine:
+        return async_session
+    if await replica_lag() > REPLICA_MAX_LAG:
+        return async_session
+    return read_async_session
+
+
+async def primary_lsn():
+    """
+    Возвращает текущую позицию WAL основной базы (текст pg_lsn) или None, если
+    узнать ее не удалось.
+    """
+    try:
+        async with engine.connect() as conn:
+            return await conn.scalar(PRIMARY_LSN_SQL)
+    except Exception as e:
+        logging.error(f"Не удалось получить позицию WAL основной базы: {e!r}")
+        return None
+
+
+async def replica_replayed(lsn):
+    """
+    Проверяет, применила ли реплика WAL основной базы до позиции lsn. Позиция
+    реплики только растет, поэтому после первого успеха база не опрашивается.
+    """
+    target = parse_lsn(lsn)
+    if replica_state["replayed"] >= target:
+        return True
+    try:
+        async with read_engine.connect() as conn:
+            replayed = await conn.scalar(REPLICA_REPLAY_LSN_SQL)
+    except Exception as e:
+        logging.warning(f"Реплика недоступна: {e!r}")
+        return False
+    if replayed is None:
+        # Не реплика: pg_last_wal_replay_lsn() пуст вне восстановления
+        return False
+    replica_state["replayed"] = max(replica_state["replayed"], parse_lsn(replayed))
+    return replica_state["replayed"] >= target
+
+
+async def fill_session(lsn):
+    """
+    Выбирает фабрику сессий для заполнения кеша поколением, строки которого
+    видны на позиции WAL lsn: реплику, если она применила WAL до lsn, иначе
+    основную базу. Без lsn поколение не привязано к позиции, и отстающая реплика
+    могла бы сохранить в кеше строки до загрузки, поэтому читается основная база.
+    """
+    if read_engine is engine or lsn is None:
+        return async_session
+    if await replica_replayed(lsn):
+        return read_async_session
+    return async_session
+
+
+def describe_pool(pool):
+    """Состояние пула соединений и время ожидания соединения (мс)."""
+    count = pool.waits["count"]
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checkouts": count,
+        "wait_avg_ms": pool.waits["total"] / count * 1000 if count else 0.0,
+        "wait_max_ms": pool.waits["max"] * 1000,
+    }
 
 
-class Base(DeclarativeBase):
-    pass
+def pool_stats():
+    """Состояние пулов основной базы и реплики."""
+    stats = {"primary": describe_pool(engine.pool)}
+    if read_engine is not engine:
+        stats["replica"] = {
+            **describe_pool(read_engine.pool),
+            "lag": replica_state["lag"],
+            "replayed_lsn": replica_state["replayed"],
+        }
+    return stats
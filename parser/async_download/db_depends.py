@@ -1,5 +1,5 @@
 from collections.abc import AsyncGenerator
-from parser.async_download.database import async_session
+from parser.async_download.database import async_session, read_session
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -10,3 +10,11 @@ async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
     """
     async with async_session() as session:
         yield session
+
+
+async def get_async_read_db() -> AsyncGenerator[AsyncSession, None]:
+    """
+    Предоставляет сессию для чтения: реплику или, если она отстает, основную базу.
+    """
+    async with (await read_session())() as session:
+        yield session
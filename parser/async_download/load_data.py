@@ -0,0 +1,517 @@
+import asyncio
+import os
+import random
+import sys
+from datetime import date, datetime, timedelta
+from parser.aggregates import (daily_rollups_statements,
+                               dimensions_statements, trading_days_statements)
+from parser.async_download.database import async_session, engine
+from parser.async_download.read_data import RECORD_FIELDS
+from parser.models import (PARTITIONS_SQL, Data, IngestedFile, Instrument,
+                           month_partitions)
+from time import time
+
+from dotenv import load_dotenv
+from sqlalchemy import column, insert, select, table, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+load_dotenv()
+
+# Способ записи в базу: copy, upsert, executemany или orm
+INGEST_MODE = os.getenv("INGEST_MODE", "copy")
+# Сколько строк записывается и коммитится за один раз
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "5000"))
+
+TABLE_COLUMNS = RECORD_FIELDS + ("created_on", "updated_on")
+
+# Естественный ключ строки (см. uq_trading_results_natural_key)
+NATURAL_KEY = ("date", "exchange_product_id", "delivery_basis_name")
+
+STAGING_TABLE = f"{Data.__tablename__}_staging"
+
+staging = table(STAGING_TABLE, *(column(name) for name in TABLE_COLUMNS))
+
+
+def with_timestamps(records):
+    """Дополняет записи парсера полями created_on и updated_on."""
+    now = datetime.now()
+    return [record + (now, now) for record in records]
+
+
+def get_data(records):
+    """
+    Превращает пачку записей парсера в словари по колонкам таблицы.
+    """
+    return [dict(zip(TABLE_COLUMNS, row)) for row in with_timestamps(records)]
+
+
+def on_conflict_update(statement):
+    """
+    Дополняет INSERT обновлением уже загруженной строки с тем же естественным ключом.
+    """
+    return statement.on_conflict_do_update(
+        index_elements=NATURAL_KEY,
+        set_={
+            name: statement.excluded[name]
+            for name in TABLE_COLUMNS
+            if name not in NATURAL_KEY and name != "created_on"
+        },
+    )
+
+
+async def load_orm(session, records):
+    """Запись через ORM: по объекту Data на строку (без обновления дублей)."""
+    session.add_all([Data(**row) for row in get_data(records)])
+
+
+async def load_executemany(session, records):
+    """Запись одним INSERT с пачкой параметров (без обновления дублей)."""
+    await session.execute(insert(Data), get_data(records))
+
+
+async def load_upsert(session, records):
+    """Запись INSERT ... ON CONFLICT DO UPDATE с пачкой параметров."""
+    await session.execute(on_conflict_update(pg_insert(Data)), get_data(records))
+
+
+async def load_copy(session, records):
+    """
+    Запись через COPY во временную таблицу и слияние одним INSERT ... ON CONFLICT.
+    """
+    await session.execute(
+        text(
+            f"CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} ON COMMIT DELETE ROWS AS "
+            f"SELECT {', '.join(TABLE_COLUMNS)} FROM {Data.__tablename__} WITH NO DATA"
+        )
+    )
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        STAGING_TABLE, records=with_timestamps(records), columns=TABLE_COLUMNS
+    )
+
+    # В одной пачке ключ может повториться: ON CONFLICT требует одну строку на ключ
+    natural_key = [staging.c[name] for name in NATURAL_KEY]
+    rows = select(*staging.c).distinct(*natural_key).order_by(*natural_key)
+    await session.execute(
+        on_conflict_update(pg_insert(Data).from_select(TABLE_COLUMNS, rows))
+    )
+
+
+async def create_partitions(session, dates):
+    """
+    Создает недостающие месячные секции таблицы сделок для дат в транзакции сессии.
+    Секции, которые уже есть, не трогаются: CREATE TABLE берет блокировку таблицы.
+
+    Возвращает:
+    - True, если какая-то секция была создана.
+    """
+    result = await session.execute(text(PARTITIONS_SQL))
+    existing = set(result.scalars().all())
+    created = False
+    for name, statement in month_partitions(dates).items():
+        if name not in existing:
+            await session.execute(text(statement))
+            created = True
+    return created
+
+
+async def ensure_partitions(dates):
+    """
+    Создает недостающие секции для дат пачки в отдельной короткой транзакции до
+    записи пачки. CREATE TABLE ... PARTITION OF берет ACCESS EXCLUSIVE на
+    spimex_trading_results, и в транзакции пачки блокировка держалась бы до ее
+    коммита, останавливая запросы API на все время COPY и пересчета итогов.
+    """
+    async with async_session() as session:
+        if await create_partitions(session, dates):
+            await session.commit()
+
+
+async def refresh_trading_days(session, dates):
+    """Пересчитывает строки trading_days для дат загруженной пачки."""
+    if not dates:
+        return
+    for statement in trading_days_statements(dates):
+        await session.execute(statement)
+
+
+async def refresh_daily_rollups(session, dates):
+    """Пересчитывает дневные итоги trading_daily_rollups для дат загруженной пачки."""
+    if not dates:
+        return
+    for statement in daily_rollups_statements(dates):
+        await session.execute(statement)
+
+
+async def refresh_dimensions(session, dates):
+    """Добавляет новые инструменты дат пачки в справочник instruments."""
+    if not dates:
+        return
+    for statement in dimensions_statements(dates):
+        await session.execute(statement)
+
+
+async def get_known_files(session):
+    """
+    Возвращает {имя файла: (размер, время изменения, хеш содержимого)} для уже
+    загруженных файлов.
+    """
+    result = await session.execute(
+        select(
+            IngestedFile.file_name,
+            IngestedFile.size,
+            IngestedFile.mtime_ns,
+            IngestedFile.content_hash,
+        )
+    )
+    return {file_name: tuple(rest) for file_name, *rest in result.all()}
+
+
+async def record_files(session, files):
+    """
+    Отмечает файлы в манифесте как загруженные.
+
+    Параметры:
+    - files: список пар (BulletinFile, пачка записей файла).
+    """
+    now = datetime.now()
+    statement = pg_insert(IngestedFile).values(
+        [
+            {
+                "file_name": bulletin.name,
+                "bulletin_date": records[0][0] if records else None,
+                "size": bulletin.size,
+                "mtime_ns": bulletin.mtime_ns,
+                "content_hash": bulletin.content_hash,
+                "rows_loaded": len(records),
+                "loaded_at": now,
+            }
+            for bulletin, records in files
+        ]
+    )
+    await session.execute(
+        statement.on_conflict_do_update(
+            index_elements=["file_name"],
+            set_={
+                column.name: statement.excluded[column.name]
+                for column in IngestedFile.__table__.columns
+                if not column.primary_key
+            },
+        )
+    )
+
+
+LOADERS = {
+    "orm": load_orm,
+    "executemany": load_executemany,
+    "upsert": load_upsert,
+    "copy": load_copy,
+}
+
+
+def get_loader(mode=INGEST_MODE):
+    try:
+        return LOADERS[mode]
+    except KeyError:
+        raise ValueError(
+            f"Неизвестный режим записи {mode}, доступны: {', '.join(LOADERS)}"
+        )
+
+
+def synthetic_records(count_rows, start=0):
+    """
+    Генерирует записи, похожие на строки бюллетеня, для замеров.
+    Естественные ключи уникальны, даты лежат в 2000 году, до реальной истории.
+    start - номер первой записи, чтобы генерировать большой объем частями.
+    """
+    records = []
+    for i in range(start, start + count_rows):
+        exchange_product_id = f"A{i % 1000:03d}{'ABCDEFGHIJ'[i % 10]}{i % 100:02d}F"
+        records.append(
+            (
+                date(2000, 1, 1) + timedelta(days=i // 1000),
+                exchange_product_id,
+                f"Инструмент {exchange_product_id}",
+                exchange_product_id[:4],
+                exchange_product_id[4:7],
+                f"Базис {exchange_product_id[4:7]}",
+                exchange_product_id[-1],
+                float(random.randint(1, 1000)),
+                float(random.randint(1000, 10**7)),
+                random.randint(1, 50),
+            )
+        )
+    return records
+
+
+async def benchmark(count_rows=50000):
+    """
+    Сравнивает скорость режимов записи. Каждая попытка откатывается.
+    """
+    records = synthetic_records(count_rows)
+    for mode, loader in LOADERS.items():
+        async with async_session() as session:
+            # Секции создаются в транзакции замера и откатываются вместе с ней
+            await create_partitions(session, {record[0] for record in records})
+            t0 = time()
+            await loader(session, records)
+            await session.flush()
+            elapsed = time() - t0
+            await session.rollback()
+        print(f"{mode}: {count_rows / elapsed:.0f} строк/с ({elapsed:.2f} c)")
+
+
+# Запросы эндпоинтов в том виде, в каком их строит app.routers
+EXPLAIN_QUERIES = {
+    "get_dynamics": """
+        SELECT exchange_product_id, exchange_product_name, delivery_basis_name,
+               volume, total, count
+        FROM {table}
+        WHERE date >= '2000-03-01' AND date <= '2000-06-01'
+    """,
+    "get_dynamics (фильтры)": """
+        SELECT exchange_product_id, exchange_product_name, delivery_basis_name,
+               volume, total, count
+        FROM {table}
+        WHERE date >= '2000-03-01' AND date <= '2000-06-01'
+          AND oil_id = 'A001' AND delivery_type_id = 'F' AND delivery_basis_id = 'B01'
+    """,
+    "get_dynamics (страница)": """
+        SELECT exchange_product_id, exchange_product_name, delivery_basis_name,
+               volume, total, count, date, id
+        FROM {table}
+        WHERE date >= '2000-03-01' AND date <= '2000-06-01'
+          AND (date, id) > ('2000-04-01', 0)
+        ORDER BY date, id
+        LIMIT 1001
+    """,
+    "get_trading_results (фильтры)": """
+        SELECT exchange_product_id, exchange_product_name, delivery_basis_name,
+               volume, total, count
+        FROM {table}
+        WHERE oil_id = 'A001' AND delivery_type_id = 'F' AND delivery_basis_id = 'B01'
+        ORDER BY date DESC, id DESC
+        LIMIT 10
+    """,
+    "get_trading_results": """
+        SELECT exchange_product_id, exchange_product_name, delivery_basis_name,
+               volume, total, count
+        FROM {table}
+        ORDER BY date DESC, id DESC
+        LIMIT 10
+    """,
+    "get_trading_results (per_instrument)": """
+        SELECT latest.exchange_product_id, latest.exchange_product_name,
+               latest.delivery_basis_name, latest.volume, latest.total, latest.count
+        FROM {instruments} instruments
+        JOIN LATERAL (
+            SELECT exchange_product_id, exchange_product_name, delivery_basis_name,
+                   volume, total, count, date, id
+            FROM {table}
+            WHERE exchange_product_id = instruments.exchange_product_id
+            ORDER BY date DESC, id DESC
+            LIMIT 1
+        ) latest ON true
+        ORDER BY latest.date DESC, latest.id DESC
+        LIMIT 10
+    """,
+}
+
+
+async def explain_indexes(count_rows=2_000_000, chunk_size=100_000):
+    """
+    Проверяет планы запросов API на синтетической таблице.
+
+    Создает копию spimex_trading_results с ее индексами, секционированную по
+    месяцам, как основная, заполняет ее через COPY, выполняет VACUUM ANALYZE
+    (без него index-only scan ходит в таблицу за видимостью строк) и печатает
+    EXPLAIN ANALYZE каждого запроса. В конце таблица удаляется.
+
+    id копии берется из собственной последовательности: INCLUDING ALL скопировал
+    бы умолчание nextval основной таблицы и расходовал бы ее значения.
+    """
+    table_name = f"{Data.__tablename__}_explain"
+    instruments_name = f"{Instrument.__tablename__}_explain"
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(
+            text(f"DROP TABLE IF EXISTS {table_name}, {instruments_name}")
+        )
+        await conn.execute(
+            text(
+                f"CREATE TABLE {table_name} "
+                f"(LIKE {Data.__tablename__} INCLUDING INDEXES) "
+                f"PARTITION BY RANGE (date)"
+            )
+        )
+        try:
+            # Последовательность принадлежит копии и удаляется вместе с ней
+            await conn.execute(
+                text(f"CREATE SEQUENCE {table_name}_id_seq OWNED BY {table_name}.id")
+            )
+            await conn.execute(
+                text(
+                    f"ALTER TABLE {table_name} ALTER COLUMN id "
+                    f"SET DEFAULT nextval('{table_name}_id_seq')"
+                )
+            )
+            # Секции под даты synthetic_records: по 1000 записей на день с 2000-01-01
+            days = [
+                date(2000, 1, 1) + timedelta(days=i)
+                for i in range((count_rows - 1) // 1000 + 1)
+            ]
+            for statement in month_partitions(days, table_name).values():
+                await conn.execute(text(statement))
+
+            raw_connection = (await conn.get_raw_connection()).driver_connection
+            t0 = time()
+            for start in range(0, count_rows, chunk_size):
+                records = synthetic_records(min(chunk_size, count_rows - start), start)
+                await raw_connection.copy_records_to_table(
+                    table_name, records=with_timestamps(records), columns=TABLE_COLUMNS
+                )
+            print(f"Загружено {count_rows} строк за {time() - t0:.2f} c")
+            await conn.execute(
+                text(
+                    f"CREATE TABLE {instruments_name} AS "
+                    f"SELECT DISTINCT exchange_product_id FROM {table_name}"
+                )
+            )
+            await conn.execute(text(f"VACUUM ANALYZE {table_name}"))
+            await conn.execute(text(f"ANALYZE {instruments_name}"))
+
+            for name, query in EXPLAIN_QUERIES.items():
+                query = query.format(table=table_name, instruments=instruments_name)
+                result = await conn.execute(text("EXPLAIN (ANALYZE, BUFFERS) " + query))
+                print(f"\n{name}:")
+                print("\n".join(result.scalars().all()))
+        finally:
+            await conn.execute(
+                text(f"DROP TABLE IF EXISTS {table_name}, {instruments_name}")
+            )
+
+
+# Таблицы сравнения хранения: исходная широкая строка и нормализованная
+# со справочниками и компактными типами
+STORAGE_TABLES = {
+    "wide": """
+        CREATE TABLE {wide} (
+            date date, exchange_product_id text, exchange_product_name text,
+            oil_id text, delivery_basis_id text, delivery_basis_name text,
+            delivery_type_id text, volume numeric(30, 8), total numeric(30, 8),
+            count numeric(30, 8)
+        )
+    """,
+    "instruments": """
+        CREATE TABLE {instruments} AS
+        SELECT (row_number() OVER ())::int AS id, *
+        FROM (
+            SELECT DISTINCT exchange_product_id, exchange_product_name, oil_id,
+                   delivery_basis_id, delivery_type_id
+            FROM {wide}
+        ) s
+    """,
+    "bases": """
+        CREATE TABLE {bases} AS
+        SELECT (row_number() OVER ())::smallint AS id, *
+        FROM (SELECT DISTINCT delivery_basis_name, delivery_basis_id FROM {wide}) s
+    """,
+    "compact": """
+        CREATE TABLE {compact} AS
+        SELECT w.date, i.id AS instrument_id, b.id AS basis_id,
+               w.volume::numeric(20, 2) AS volume, w.total::numeric(20, 2) AS total,
+               w.count::bigint AS count
+        FROM {wide} w
+        JOIN {instruments} i USING (exchange_product_id)
+        JOIN {bases} b USING (delivery_basis_name)
+    """,
+}
+
+# Одни и те же запросы к широкой и нормализованной таблицам
+STORAGE_QUERIES = {
+    "итоги по видам нефти за квартал": (
+        """
+        SELECT oil_id, sum(volume), sum(total), sum(count) FROM {wide}
+        WHERE date >= '2005-01-01' AND date < '2005-04-01'
+        GROUP BY oil_id
+        """,
+        """
+        SELECT i.oil_id, sum(c.volume), sum(c.total), sum(c.count)
+        FROM {compact} c JOIN {instruments} i ON i.id = c.instrument_id
+        WHERE c.date >= '2005-01-01' AND c.date < '2005-04-01'
+        GROUP BY i.oil_id
+        """,
+    ),
+    "сделки за год (проекция Trades)": (
+        """
+        SELECT exchange_product_id, exchange_product_name, delivery_basis_name,
+               volume, total, count
+        FROM {wide}
+        WHERE date >= '2005-01-01' AND date < '2006-01-01'
+        """,
+        """
+        SELECT i.exchange_product_id, i.exchange_product_name,
+               b.delivery_basis_name, c.volume, c.total, c.count
+        FROM {compact} c
+        JOIN {instruments} i ON i.id = c.instrument_id
+        JOIN {bases} b ON b.id = c.basis_id
+        WHERE c.date >= '2005-01-01' AND c.date < '2006-01-01'
+        """,
+    ),
+}
+
+
+async def execution_time(conn, query):
+    """Время выполнения запроса на сервере (мс) по EXPLAIN ANALYZE."""
+    result = await conn.execute(text("EXPLAIN (ANALYZE, FORMAT JSON) " + query))
+    return result.scalar()[0]["Execution Time"]
+
+
+async def compare_storage(count_rows=10_000_000, chunk_size=100_000):
+    """
+    Сравнивает размер строки и скорость сканирования широкой таблицы сделок
+    (строки наименований и Numeric(30, 8)) и нормализованной (id справочников,
+    numeric(20, 2) и bigint) на синтетических данных. Таблицы удаляются в конце.
+    """
+    names = {name: f"{Data.__tablename__}_storage_{name}" for name in STORAGE_TABLES}
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        drop = text(f"DROP TABLE IF EXISTS {', '.join(names.values())}")
+        await conn.execute(drop)
+        try:
+            await conn.execute(text(STORAGE_TABLES["wide"].format(**names)))
+            raw_connection = (await conn.get_raw_connection()).driver_connection
+            for start in range(0, count_rows, chunk_size):
+                records = synthetic_records(min(chunk_size, count_rows - start), start)
+                await raw_connection.copy_records_to_table(
+                    names["wide"], records=records, columns=RECORD_FIELDS
+                )
+            for name in ("instruments", "bases", "compact"):
+                await conn.execute(text(STORAGE_TABLES[name].format(**names)))
+            for table_name in names.values():
+                await conn.execute(text(f"VACUUM ANALYZE {table_name}"))
+
+            for name in ("wide", "compact"):
+                size = await conn.scalar(text(f"SELECT pg_table_size('{names[name]}')"))
+                print(
+                    f"{name}: {size / 2**20:.0f} МБ, "
+                    f"{size / count_rows:.1f} байт/строку"
+                )
+
+            for title, (wide_query, compact_query) in STORAGE_QUERIES.items():
+                wide_ms = await execution_time(conn, wide_query.format(**names))
+                compact_ms = await execution_time(conn, compact_query.format(**names))
+                print(f"{title}: wide {wide_ms:.0f} мс, compact {compact_ms:.0f} мс")
+        finally:
+            await conn.execute(drop)
+
+
+if __name__ == "__main__":
+    # python -m parser.async_download.load_data [explain | storage]
+    if sys.argv[1:] == ["explain"]:
+        asyncio.run(explain_indexes())
+    elif sys.argv[1:] == ["storage"]:
+        asyncio.run(compare_storage())
+    else:
+        asyncio.run(benchmark())
@@ -0,0 +1,256 @@
+from datetime import datetime
+from parser.models import Data, month_partitions
+
+from sqlalchemy import text
+
+LEGACY_TABLE = f"{Data.__tablename__}_legacy"
+
+
+async def partition_trading_results(conn):
+    """
+    Переносит несекционированную таблицу сделок в секционированную по месяцам.
+
+    Старая таблица переименовывается вместе с первичным ключом и
+    последовательностью id, новая создается по модели Data. Затем создаются
+    секции под все месяцы истории, строки копируются с приведением date к дате,
+    и старая таблица удаляется. В новой базе create_all уже создал
+    секционированную таблицу, и перенос не нужен.
+    """
+    table = Data.__tablename__
+    relkind = await conn.scalar(
+        text(f"SELECT relkind FROM pg_class WHERE oid = to_regclass('{table}')")
+    )
+    if relkind == "p":
+        return
+
+    await conn.execute(text(f"ALTER TABLE {table} RENAME TO {LEGACY_TABLE}"))
+    await conn.execute(
+        text(
+            f"ALTER TABLE {LEGACY_TABLE} "
+            f"RENAME CONSTRAINT {table}_pkey TO {LEGACY_TABLE}_pkey"
+        )
+    )
+    await conn.execute(
+        text(f"ALTER SEQUENCE {table}_id_seq RENAME TO {LEGACY_TABLE}_id_seq")
+    )
+    # Имена индексов понадобятся новой таблице
+    for index in Data.__table__.indexes:
+        await conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+    await conn.execute(text("DROP INDEX IF EXISTS idx_date"))
+
+    await conn.run_sync(Data.__table__.create)
+
+    result = await conn.execute(
+        text(f"SELECT DISTINCT date::date FROM {LEGACY_TABLE} WHERE date IS NOT NULL")
+    )
+    for statement in month_partitions(result.scalars().all()).values():
+        await conn.execute(text(statement))
+
+    columns = [column.name for column in Data.__table__.columns]
+    natural_key = "date::date, exchange_product_id, delivery_basis_name"
+    select_columns = ", ".join(
+        "date::date" if name == "date" else name for name in columns
+    )
+    # Синхронный загрузчик хранил date как timestamp: после приведения к дате
+    # ключ может повториться, оставляем последнюю загруженную строку
+    await conn.execute(
+        text(
+            f"INSERT INTO {table} ({', '.join(columns)}) "
+            f"SELECT DISTINCT ON ({natural_key}) {select_columns} "
+            f"FROM {LEGACY_TABLE} WHERE date IS NOT NULL "
+            f"ORDER BY {natural_key}, id DESC"
+        )
+    )
+    await conn.execute(
+        text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE(max(id), 0) + 1, false) FROM {table}"
+        )
+    )
+    await conn.execute(text(f"DROP TABLE {LEGACY_TABLE}"))
+
+
+# Изменения схемы для уже существующих баз. create_all создает только новые
+# таблицы, поэтому индексы и правки существующих таблиц описываются здесь.
+# Шаг миграции - SQL-запрос или async-функция, получающая соединение.
+# Каждая миграция выполняется один раз и записывается в schema_migrations.
+# Миграции выполняются в порядке списка, а не номеров версий.
+MIGRATIONS = [
+    (
+        "0001_trading_results_natural_key",
+        [
+            # Строки без кода инструмента или базиса (итоги, подзаголовки бюллетеня)
+            # парсер больше не загружает; убираем загруженные раньше
+            """
+            DELETE FROM spimex_trading_results
+            WHERE exchange_product_id IS NULL OR delivery_basis_name IS NULL
+            """,
+            # Перед созданием уникального индекса оставляем последнюю загруженную копию строки
+            """
+            DELETE FROM spimex_trading_results a
+            USING spimex_trading_results b
+            WHERE a.id < b.id
+              AND a.date = b.date
+              AND a.exchange_product_id = b.exchange_product_id
+              AND a.delivery_basis_name = b.delivery_basis_name
+            """,
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_trading_results_natural_key
+            ON spimex_trading_results (date, exchange_product_id, delivery_basis_name)
+            """,
+        ],
+    ),
+    (
+        "0002_trading_results_query_indexes",
+        [
+            # Фильтры API: вид нефти, тип и базис поставки плюс диапазон дат.
+            # INCLUDE с полями схемы Trades позволяет отвечать index-only scan
+            """
+            CREATE INDEX IF NOT EXISTS idx_trading_results_filters
+            ON spimex_trading_results (oil_id, delivery_type_id, delivery_basis_id, date)
+            INCLUDE (exchange_product_id, exchange_product_name, delivery_basis_name,
+                     volume, total, count)
+            """,
+            # Диапазон дат без фильтров и постраничная выдача по (date, id);
+            # заменяет idx_date
+            """
+            CREATE INDEX IF NOT EXISTS idx_trading_results_date_covering
+            ON spimex_trading_results (date, id)
+            INCLUDE (exchange_product_id, exchange_product_name, delivery_basis_name,
+                     volume, total, count)
+            """,
+            "DROP INDEX IF EXISTS idx_date",
+            # История дописывается по дням, поэтому date коррелирует с физическим
+            # порядком строк и BRIN занимает единицы страниц
+            """
+            CREATE INDEX IF NOT EXISTS brin_trading_results_date
+            ON spimex_trading_results USING brin (date)
+            """,
+        ],
+    ),
+    (
+        "0003_trading_results_latest_indexes",
+        [
+            # id в ключе фильтрующего индекса: последние сделки по фильтрам
+            # (ORDER BY date DESC, id DESC) читаются обратным проходом без сортировки
+            "DROP INDEX IF EXISTS idx_trading_results_filters",
+            """
+            CREATE INDEX IF NOT EXISTS idx_trading_results_filters
+            ON spimex_trading_results
+                (oil_id, delivery_type_id, delivery_basis_id, date, id)
+            INCLUDE (exchange_product_id, exchange_product_name, delivery_basis_name,
+                     volume, total, count)
+            """,
+            # Последняя сделка по каждому инструменту (DISTINCT ON)
+            """
+            CREATE INDEX IF NOT EXISTS idx_trading_results_product_latest
+            ON spimex_trading_results (exchange_product_id, date DESC, id DESC)
+            INCLUDE (exchange_product_name, delivery_basis_name, volume, total, count)
+            """,
+        ],
+    ),
+    # Перенос в секционированную таблицу выполняется до заполнения итогов: в
+    # таблице синхронного загрузчика date - timestamp момента загрузки строки, и
+    # только после переноса date становится датой, а дубли одного дня удаляются
+    ("0006_partition_trading_results", [partition_trading_results]),
+    (
+        "0004_trading_days_backfill",
+        [
+            # Таблицу создает create_all, здесь она заполняется по загруженной истории
+            """
+            INSERT INTO trading_days (date, row_count, total_volume, loaded_at)
+            SELECT date, count(*), sum(volume), now()
+            FROM spimex_trading_results
+            WHERE date IS NOT NULL
+            GROUP BY date
+            ON CONFLICT (date) DO NOTHING
+            """,
+        ],
+    ),
+    (
+        "0005_daily_rollups_backfill",
+        [
+            """
+            INSERT INTO trading_daily_rollups
+                (date, oil_id, delivery_basis_id, delivery_type_id,
+                 volume, total, count, instruments)
+            SELECT date, oil_id, delivery_basis_id, delivery_type_id,
+                   sum(volume), sum(total), sum(count),
+                   count(DISTINCT exchange_product_id)
+            FROM spimex_trading_results
+            -- Все поля ключа trading_daily_rollups обязательны
+            WHERE date IS NOT NULL
+              AND oil_id IS NOT NULL
+              AND delivery_basis_id IS NOT NULL
+              AND delivery_type_id IS NOT NULL
+            GROUP BY date, oil_id, delivery_basis_id, delivery_type_id
+            ON CONFLICT DO NOTHING
+            """,
+        ],
+    ),
+    (
+        "0007_compact_types_and_dimensions",
+        [
+            """
+            ALTER TABLE spimex_trading_results
+                ALTER COLUMN volume TYPE numeric(20, 2),
+                ALTER COLUMN total TYPE numeric(20, 2),
+                ALTER COLUMN count TYPE bigint USING round(count)::bigint
+            """,
+            """
+            ALTER TABLE trading_daily_rollups
+                ALTER COLUMN volume TYPE numeric(20, 2),
+                ALTER COLUMN total TYPE numeric(20, 2),
+                ALTER COLUMN count TYPE bigint USING round(count)::bigint
+            """,
+            """
+            ALTER TABLE trading_days
+                ALTER COLUMN total_volume TYPE numeric(20, 2)
+            """,
+            # Справочники заполняются по загруженной истории, последняя строка побеждает
+            """
+            INSERT INTO instruments
+                (exchange_product_id, exchange_product_name, oil_id,
+                 delivery_basis_id, delivery_type_id)
+            SELECT DISTINCT ON (exchange_product_id)
+                   exchange_product_id, exchange_product_name, oil_id,
+                   delivery_basis_id, delivery_type_id
+            FROM spimex_trading_results
+            WHERE exchange_product_id IS NOT NULL
+            ORDER BY exchange_product_id, date DESC, id DESC
+            ON CONFLICT DO NOTHING
+            """,
+        ],
+    ),
+    (
+        "0008_ingested_files_mtime",
+        ["ALTER TABLE ingested_files ADD COLUMN IF NOT EXISTS mtime_ns bigint"],
+    ),
+    # Справочник базисов никто не читал; create_all мог создать его раньше
+    ("0009_drop_delivery_bases", ["DROP TABLE IF EXISTS delivery_bases"]),
+]
+
+
+async def apply_migrations(conn):
+    """
+    Применяет еще не выполненные миграции в порядке их объявления.
+    """
+    result = await conn.execute(text("SELECT version FROM schema_migrations"))
+    applied = set(result.scalars().all())
+
+    for version, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        for statement in statements:
+            if callable(statement):
+                await statement(conn)
+            else:
+                await conn.execute(text(statement))
+        await conn.execute(
+            text(
+                "INSERT INTO schema_migrations (version, applied_on) "
+                "VALUES (:version, :applied_on)"
+            ),
+            {"version": version, "applied_on": datetime.now()},
+        )
+        print(f"Применена миграция {version}")
@@ -1,9 +1,24 @@
-import asyncio
+import glob
+import hashlib
 import logging
 import os
 import re
+import sys
+from datetime import datetime
+from time import time
+from typing import NamedTuple
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Число процессов для разбора файлов (0 - читать в одном потоке)
+READ_WORKERS = int(os.getenv("READ_WORKERS", "0"))
+# Сохранять разобранные бюллетени в Parquet и читать их оттуда при повторной загрузке
+PARQUET_CACHE = os.getenv("PARQUET_CACHE", "true").lower() == "true"
 
 current_dir = os.path.dirname(__file__)
 data_dir = os.path.join(current_dir, "..", "..", "data", "async_files")
@@ -17,75 +32,351 @@ logging.basicConfig(
     ],
 )
 
+# Многострочные заголовки бюллетеня -> имена колонок таблицы
+COLUMNS = {
+    "Код\nИнструмента": "exchange_product_id",
+    "Наименование\nИнструмента": "exchange_product_name",
+    "Базис\nпоставки": "delivery_basis_name",
+    "Объем\nДоговоров\nв единицах\nизмерения": "volume",
+    "Обьем\nДоговоров,\nруб.": "total",
+    "Количество\nДоговоров,\nшт.": "count",
+}
 
-async def read_excel_file(filepath):
-    def process():
-        try:
-            # Читаем первую строку для извлечения числа
-            df_header = pd.read_excel(filepath, header=None, skiprows=3, nrows=1)
+NUMERIC_FIELDS = ("volume", "total", "count")
+
+# Порядок полей в кортежах, которые отдает парсер
+RECORD_FIELDS = (
+    "date",
+    "exchange_product_id",
+    "exchange_product_name",
+    "oil_id",
+    "delivery_basis_id",
+    "delivery_basis_name",
+    "delivery_type_id",
+    "volume",
+    "total",
+    "count",
+)
+
+
+# Типы колонок Parquet-копии бюллетеня, в порядке RECORD_FIELDS
+PARQUET_SCHEMA = pa.schema(
+    [
+        ("date", pa.date32()),
+        ("exchange_product_id", pa.string()),
+        ("exchange_product_name", pa.string()),
+        ("oil_id", pa.string()),
+        ("delivery_basis_id", pa.string()),
+        ("delivery_basis_name", pa.string()),
+        ("delivery_type_id", pa.string()),
+        ("volume", pa.float64()),
+        ("total", pa.float64()),
+        ("count", pa.int64()),
+    ]
+)
+
+PARQUET_SUFFIX = ".parquet"
+# Версия разбора: увеличивается при любом изменении frame_to_records или
+# PARQUET_SCHEMA, чтобы копии, сделанные прежним разбором, не читались
+PARQUET_VERSION = 1
+PART_SUFFIX = ".part"
+
+
+class BulletinFile(NamedTuple):
+    path: str
+    name: str
+    size: int
+    mtime_ns: int
+    content_hash: str
+
+
+def _to_objects(series):
+    """Переводит колонку в python-объекты, заменяя пропуски на None."""
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def frame_to_records(df, date):
+    """
+    Векторно превращает таблицу бюллетеня в пачку записей.
+
+    Параметры:
+    - df: DataFrame, прочитанный из бюллетеня (с исходными заголовками).
+    - date: дата бюллетеня.
+
+    Возвращает:
+    - список кортежей в порядке RECORD_FIELDS.
+    """
+    df = df.rename(columns=COLUMNS)[list(COLUMNS.values())]
+
+    for field in NUMERIC_FIELDS:
+        df[field] = pd.to_numeric(df[field], errors="coerce").fillna(0)
+
+    # Строки без кода инструмента или базиса (итоги, подзаголовки) не сохраняем:
+    # по ним нельзя построить естественный ключ записи
+    is_product = df["exchange_product_id"].map(type) == str
+    df = df[(df["count"] > 0) & is_product & df["delivery_basis_name"].notna()]
+
+    product_id = df["exchange_product_id"].astype("string")
+
+    columns = {
+        "date": [date] * len(df),
+        "exchange_product_id": _to_objects(product_id),
+        "exchange_product_name": _to_objects(df["exchange_product_name"]),
+        "oil_id": _to_objects(product_id.str[:4]),
+        "delivery_basis_id": _to_objects(product_id.str[4:7]),
+        "delivery_basis_name": _to_objects(df["delivery_basis_name"]),
+        "delivery_type_id": _to_objects(product_id.str[-1]),
+        "volume": df["volume"].tolist(),
+        "total": df["total"].tolist(),
+        "count": df["count"].astype("int64").tolist(),
+    }
+    return list(zip(*(columns[field] for field in RECORD_FIELDS)))
+
+
+def parse_file(filepath):
+    """
+    Читает бюллетень и возвращает пачку записей (см. frame_to_records).
+    Если файл разобрать не удалось, возвращает None.
+    """
+    try:
+        # Книга открывается один раз, дата и таблица читаются из нее
+        with pd.ExcelFile(filepath) as excel:
+            df_header = excel.parse(header=None, skiprows=3, nrows=1)
             text_with_number = df_header.iloc[0, 1]
 
-            # Извлекаем число
             number_match = re.search(r"\d{2}\.\d{2}\.\d{4}", str(text_with_number))
-
-            if number_match:
-                number = number_match.group()
-            else:
-                number = None
+            if not number_match:
+                logging.error(f"В файле {filepath} не найдена дата бюллетеня")
+                return None
+            date = datetime.strptime(number_match.group(), "%d.%m.%Y").date()
 
             # Читаем весь DataFrame с пропусками строк
-            df = pd.read_excel(filepath, skiprows=6)
+            df = excel.parse(skiprows=6)
+        return frame_to_records(df, date)
+
+    except Exception as e:
+        logging.error(f"Ошибка при обработке файла {filepath}: {e}")
+        return None
 
-            df["Количество\nДоговоров,\nшт."] = pd.to_numeric(
-                df["Количество\nДоговоров,\nшт."], errors="coerce"
-            ).fillna(0)
 
-            filtered_df = df[df["Количество\nДоговоров,\nшт."] > 0]
+def parquet_path(bulletin):
+    """
+    Путь к Parquet-копии бюллетеня: рядом с .xls, с хешем содержимого
+    и версией разбора в имени.
+    """
+    return (
+        f"{bulletin.path}.{bulletin.content_hash}.v{PARQUET_VERSION}{PARQUET_SUFFIX}"
+    )
 
-            results = []
 
-            for _, row in filtered_df.iterrows():
-                results.append(
-                    {
-                        "date": number,
-                        "exchange_product_id": row["Код\nИнструмента"],
-                        "exchange_product_name": row["Наименование\nИнструмента"],
-                        "delivery_basis_name": row["Базис\nпоставки"],
-                        "volume": row["Объем\nДоговоров\nв единицах\nизмерения"],
-                        "total": row["Обьем\nДоговоров,\nруб."],
-                        "count": row["Количество\nДоговоров,\nшт."],
-                    }
-                )
+def write_parquet(bulletin, records):
+    """
+    Сохраняет разобранные записи бюллетеня в Parquet. Файл пишется во временный
+    и атомарно переименовывается; копии прежнего содержимого файла и прежних
+    версий разбора удаляются.
+    """
+    path = parquet_path(bulletin)
+    columns = list(zip(*records)) or [()] * len(RECORD_FIELDS)
+    table = pa.Table.from_arrays(
+        [
+            pa.array(column, type=field.type)
+            for column, field in zip(columns, PARQUET_SCHEMA)
+        ],
+        schema=PARQUET_SCHEMA,
+    )
+    pq.write_table(table, path + PART_SUFFIX)
+    os.replace(path + PART_SUFFIX, path)
 
-            return results
+    for stale in glob.glob(f"{glob.escape(bulletin.path)}.*{PARQUET_SUFFIX}"):
+        if stale != path:
+            os.remove(stale)
 
+
+def read_parquet(path):
+    """Читает записи бюллетеня из Parquet через memory-mapping."""
+    table = pq.read_table(path, columns=list(RECORD_FIELDS), memory_map=True)
+    return list(zip(*(table.column(field).to_pylist() for field in RECORD_FIELDS)))
+
+
+def read_bulletin(bulletin):
+    """
+    Возвращает пачку записей бюллетеня (BulletinFile): из Parquet-копии с тем же
+    хешем содержимого, если она есть, иначе разбирает .xls и сохраняет копию.
+    Если файл разобрать не удалось, возвращает None.
+    """
+    path = parquet_path(bulletin)
+    if PARQUET_CACHE and os.path.exists(path):
+        try:
+            return read_parquet(path)
+        except Exception as e:
+            logging.warning(f"Не удалось прочитать {path}, разбираем .xls: {e}")
+
+    records = parse_file(bulletin.path)
+    if PARQUET_CACHE and records is not None:
+        try:
+            write_parquet(bulletin, records)
         except Exception as e:
-            logging.error(f"Ошибка при обработке файла {filepath}: {e}")
-            return []
+            logging.warning(f"Не удалось сохранить {path}: {e}")
+    return records
+
+
+def read_parquet_cache(data_dir):
+    """
+    Собирает Parquet-копии бюллетеней директории текущей версии разбора в одну
+    таблицу pyarrow (для разовых выгрузок и аналитики без обращения к базе).
+    """
+    pattern = f"*.v{PARQUET_VERSION}{PARQUET_SUFFIX}"
+    paths = sorted(glob.glob(os.path.join(glob.escape(data_dir), pattern)))
+    if not paths:
+        return PARQUET_SCHEMA.empty_table()
+    return pa.concat_tables([pq.read_table(path, memory_map=True) for path in paths])
+
+
+def file_hash(filepath):
+    """Считает sha256 содержимого файла."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
-    # Вызов всей обработки в одном потоке
-    results = await asyncio.to_thread(process)
-    # Генерируем результаты по одному
-    for item in results:
-        yield item
+def bulletin_file(filepath, stat=None):
+    """Собирает сведения о файле для манифеста."""
+    stat = stat or os.stat(filepath)
+    return BulletinFile(
+        filepath,
+        os.path.basename(filepath),
+        stat.st_size,
+        stat.st_mtime_ns,
+        file_hash(filepath),
+    )
 
 
-async def read_files_in_dir(data_dir):
-    for filename in os.listdir(data_dir):
-        if not filename:
-            print("Директория пуста")
-            logging.info("Директория пуста")
+def list_bulletins(data_dir, known=None):
+    """
+    Собирает файлы бюллетеней директории, пропуская уже загруженные.
+
+    Параметры:
+    - data_dir: директория с файлами.
+    - known: словарь {имя файла: (размер, время изменения, хеш содержимого)}
+      уже загруженных файлов.
+
+    Возвращает:
+    - список BulletinFile для новых и изменившихся файлов.
+
+    Файл, размер и время изменения которого совпадают с манифестом, не читается:
+    хеш считается только для новых и тронутых файлов.
+    """
+    known = known or {}
+    bulletins = []
+    for filename in sorted(os.listdir(data_dir)):
         filepath = os.path.join(data_dir, filename)
+        # Рядом с бюллетенями лежат недокачанные .part и служебные .meta файлы
+        if not filename.endswith(".xls") or not os.path.isfile(filepath):
+            continue
+        size, mtime_ns, content_hash = known.get(filename, (None, None, None))
+        stat = os.stat(filepath)
+        if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns):
+            continue
+        bulletin = bulletin_file(filepath, stat)
+        if bulletin.content_hash != content_hash:
+            bulletins.append(bulletin)
+    return bulletins
 
-        if os.path.isfile(filepath):
-            async for data in read_excel_file(filepath):
-                yield data
 
+def synthetic_frame(count_rows):
+    """
+    Генерирует таблицу с заголовками бюллетеня для замеров разбора: строки
+    инструментов вперемешку с итоговыми строками без кода и с прочерками в
+    количестве, как в настоящих файлах.
+    """
+    rows = []
+    for i in range(count_rows):
+        if i % 50 == 49:
+            rows.append([None, "Итого:", None, None, None, "-"])
+            continue
+        exchange_product_id = f"A{i % 1000:03d}{'ABCDEFGHIJ'[i % 10]}{i % 100:02d}F"
+        rows.append(
+            [
+                exchange_product_id,
+                f"Инструмент {exchange_product_id}",
+                f"Базис {exchange_product_id[4:7]}",
+                float(i % 1000 + 1),
+                float(i % 100000 * 100),
+                str(i % 7) if i % 3 else i % 7,
+            ]
+        )
+    return pd.DataFrame(rows, columns=list(COLUMNS))
 
-if __name__ == "__main__":
 
-    async def main():
-        async for data in read_files_in_dir(data_dir):
+def iterrows_records(df, date):
+    """
+    Прежнее построчное преобразование (iterrows) в записи RECORD_FIELDS.
+    Оставлено только для сравнения с frame_to_records в замере.
+    """
+    count_column = "Количество\nДоговоров,\nшт."
+    df = df.copy()
+    df[count_column] = pd.to_numeric(df[count_column], errors="coerce").fillna(0)
+    records = []
+    for _, row in df[df[count_column] > 0].iterrows():
+        exchange_product_id = row["Код\nИнструмента"]
+        if not isinstance(exchange_product_id, str):
             continue
+        volume = pd.to_numeric(row["Объем\nДоговоров\nв единицах\nизмерения"], errors="coerce")
+        total = pd.to_numeric(row["Обьем\nДоговоров,\nруб."], errors="coerce")
+        records.append(
+            (
+                date,
+                exchange_product_id,
+                row["Наименование\nИнструмента"],
+                exchange_product_id[:4],
+                exchange_product_id[4:7],
+                row["Базис\nпоставки"],
+                exchange_product_id[-1],
+                0 if pd.isna(volume) else float(volume),
+                0 if pd.isna(total) else float(total),
+                int(row[count_column]),
+            )
+        )
+    return records
+
+
+def convert_benchmark(count_rows=100_000):
+    """
+    Сравнивает скорость преобразования таблицы бюллетеня в записи: построчного
+    iterrows и векторного frame_to_records, на синтетической таблице.
+    """
+    df = synthetic_frame(count_rows)
+    bulletin_date = datetime(2000, 1, 1).date()
+    results = {}
+    for name, convert in (
+        ("iterrows", iterrows_records),
+        ("frame_to_records", frame_to_records),
+    ):
+        t0 = time()
+        records = convert(df, bulletin_date)
+        elapsed = time() - t0
+        results[name] = records
+        print(
+            f"{name}: {len(records)} записей за {elapsed:.3f} c, "
+            f"{count_rows / elapsed:.0f} строк/с"
+        )
+    if results["iterrows"] != results["frame_to_records"]:
+        print("Внимание: результаты преобразований различаются")
+
+
+if __name__ == "__main__":
+    # python -m parser.async_download.read_data [convert]
+    if sys.argv[1:] == ["convert"]:
+        convert_benchmark()
+        sys.exit()
 
-    asyncio.run(main())
+    t0 = time()
+    count_rows = 0
+    for bulletin in list_bulletins(data_dir):
+        count_rows += len(read_bulletin(bulletin) or [])
+    elapsed = time() - t0
+    print(f"Прочитано строк: {count_rows} за {elapsed:.2f} c")
+    if elapsed:
+        print(f"Скорость: {count_rows / elapsed:.0f} строк/с")
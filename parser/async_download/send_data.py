@@ -1,12 +1,25 @@
 import asyncio
+import json
 import logging
 import math
 import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from parser.async_download.cache_generation import bump_generation
 from parser.async_download.data_parser import main_load
-from parser.async_download.database import async_session
-from parser.async_download.models import Data, start_db
-from parser.async_download.read_data import data_dir, read_files_in_dir
+from parser.async_download.database import async_session, primary_lsn
+from parser.async_download.load_data import (INGEST_BATCH_SIZE, INGEST_MODE,
+                                             NATURAL_KEY, ensure_partitions,
+                                             get_known_files, get_loader,
+                                             record_files,
+                                             refresh_daily_rollups,
+                                             refresh_dimensions,
+                                             refresh_trading_days)
+from parser.async_download.models import start_db
+from parser.async_download.read_data import (NUMERIC_FIELDS, READ_WORKERS,
+                                             RECORD_FIELDS, bulletin_file,
+                                             data_dir, list_bulletins,
+                                             read_bulletin)
 from time import time
 
 current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -34,109 +47,243 @@ stream_handler = logging.StreamHandler()
 logger_report.addHandler(file_handler)
 logger_report.addHandler(stream_handler)
 
-ignore_fields = [
-    "oil_id",
-    "id",
-    "_sa_instance_state",
-    "delivery_basis_id",
-    "delivery_type_id",
-]
-
-semaphore = asyncio.BoundedSemaphore(100)
-
-stop_event = asyncio.Event()
-
-objects_to_save = []
-
-
-async def get_data(data_dict):
-    volume = data_dict.get("volume", 0)
-    total = data_dict.get("total", 0)
-    count = data_dict.get("count", 0)
-    date_str = data_dict.get("date")
-    date_obj = datetime.strptime(date_str, "%d.%m.%Y").date()
-
-    # Проверяем и заменяем nan на 0
-    if isinstance(volume, float) and math.isnan(volume):
-        volume = 0
-    if isinstance(total, float) and math.isnan(total):
-        total = 0
-    if isinstance(count, float) and math.isnan(count):
-        count = 0
-
-    exchange_product_id = data_dict.get("exchange_product_id")
-    if exchange_product_id and isinstance(exchange_product_id, str):
-        oil_id = exchange_product_id[:4]
-        delivery_basis_id = exchange_product_id[4:7]
-        delivery_type_id = exchange_product_id[-1]
-    else:
-        oil_id = None
-        delivery_basis_id = None
-        delivery_type_id = None
-    data = Data(
-        exchange_product_id=exchange_product_id,
-        exchange_product_name=data_dict.get("exchange_product_name", None),
-        oil_id=oil_id,
-        delivery_basis_id=delivery_basis_id,
-        delivery_basis_name=data_dict.get("delivery_basis_name", None),
-        delivery_type_id=delivery_type_id,
-        volume=volume,
-        total=total,
-        count=count,
-        date=date_obj,
-        created_on=datetime.now(),
-        updated_on=datetime.now(),
-    )
-    yield data
-
-
-async def send_data():
+# Сколько строк одновременно может находиться между разбором и записью в базу
+PIPELINE_MAX_ROWS = int(os.getenv("PIPELINE_MAX_ROWS", "50000"))
+# Файл для строк, отклоненных проверкой или базой
+dead_letter_file = os.path.join(current_dir, "..", "..", "logs", "dead_letter.jsonl")
+
+
+def validate_record(record):
+    """
+    Проверяет строку перед записью.
+
+    Возвращает:
+    - описание ошибки или None, если строка корректна.
+    """
+    row = dict(zip(RECORD_FIELDS, record))
+    for field in NATURAL_KEY:
+        if row[field] is None:
+            return f"не заполнено поле {field}"
+    for field in NUMERIC_FIELDS:
+        if not math.isfinite(row[field]) or row[field] < 0:
+            return f"некорректное значение {field}: {row[field]}"
+    return None
+
+
+def write_dead_letters(file_name, records, reason):
+    """Дописывает отклоненные строки в dead_letter.jsonl."""
+    with open(dead_letter_file, "a", encoding="utf-8") as f:
+        for record in records:
+            line = {
+                "file": file_name,
+                "reason": reason,
+                "record": dict(zip(RECORD_FIELDS, record)),
+            }
+            f.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+
+
+async def flush(session, loader, batch, files):
+    """
+    Записывает пачку строк, отмечает ее файлы в манифесте и коммитит.
+
+    Параметры:
+    - batch: строки пачки.
+    - files: пары (BulletinFile, записи файла), из которых собрана пачка.
+
+    Возвращает:
+    - количество сохраненных строк (0, если пачка откатилась).
+    """
+    try:
+        if batch:
+            dates = {record[0] for record in batch}
+            await ensure_partitions(dates)
+            await loader(session, batch)
+            await refresh_trading_days(session, dates)
+            await refresh_daily_rollups(session, dates)
+            await refresh_dimensions(session, dates)
+        await record_files(session, files)
+        await session.commit()
+    except Exception as e:
+        print(f"Ошибка при сохранении пачки данных: {e}")
+        logging.error(e)
+        await session.rollback()
+        # Файлы пачки не попали в манифест и будут загружены повторно в следующий раз
+        for bulletin, records in files:
+            await asyncio.to_thread(
+                write_dead_letters, bulletin.name, records, f"ошибка записи: {e}"
+            )
+        return 0
+    return len(batch)
+
+
+async def download_stage(paths_queue, known, download):
+    """
+    Кладет в очередь файлы, которые уже лежат в директории и еще не загружены
+    (BulletinFile с уже посчитанным хешем), а затем (если download) пути файлов,
+    скачиваемых парсером.
+    """
+    for bulletin in await asyncio.to_thread(list_bulletins, data_dir, known):
+        await paths_queue.put(bulletin)
+    if download:
+        await main_load(paths_queue)
+
+
+async def parse_stage(paths_queue, files_queue, executor, seen, known):
+    """
+    Разбирает файлы из очереди (в пуле процессов или в отдельном потоке).
+    Уже разобранные файлы читаются из Parquet-копий (см. read_data.read_bulletin).
+    Хеш считается только для путей, пришедших от парсера: файлы из директории
+    приходят готовыми BulletinFile. Скачанный файл с тем же содержимым, что
+    записано в манифесте known, пропускается: сервер мог отдать его заново
+    без изменений (REVALIDATE_FILES).
+    """
+    loop = asyncio.get_running_loop()
+    while (bulletin := await paths_queue.get()) is not None:
+        filepath = bulletin if isinstance(bulletin, str) else bulletin.path
+        if filepath in seen:
+            continue
+        seen.add(filepath)
+        if isinstance(bulletin, str):
+            bulletin = await asyncio.to_thread(bulletin_file, filepath)
+            _, _, content_hash = known.get(bulletin.name, (None, None, None))
+            if bulletin.content_hash == content_hash:
+                continue
+        records = await loop.run_in_executor(executor, read_bulletin, bulletin)
+        if records is None:
+            # Файл не разобран: в манифест не пишем, попробуем в следующий раз
+            continue
+        await files_queue.put((bulletin, records))
+
+
+async def transform_stage(files_queue, batches_queue, parsers, batch_size):
+    """
+    Отбраковывает некорректные строки и собирает файлы в пачки по batch_size строк.
+    """
+    batch = []
+    files = []
+    finished = 0
+    while finished < parsers:
+        item = await files_queue.get()
+        if item is None:
+            finished += 1
+            continue
+        bulletin, records = item
+
+        valid = []
+        for record in records:
+            reason = validate_record(record)
+            if reason:
+                await asyncio.to_thread(
+                    write_dead_letters, bulletin.name, [record], reason
+                )
+            else:
+                valid.append(record)
+
+        batch.extend(valid)
+        files.append((bulletin, valid))
+        if len(batch) >= batch_size:
+            await batches_queue.put((batch, files))
+            batch = []
+            files = []
+
+    if files:
+        await batches_queue.put((batch, files))
+    await batches_queue.put(None)
+
+
+async def load_stage(batches_queue, loader, committed):
+    """
+    Записывает пачки в базу, коммитя каждую отдельно.
+    Число закоммиченных строк копится в committed["rows"], чтобы оно было
+    известно и при сбое другого этапа конвейера.
+    """
     async with async_session() as session:
-        async with semaphore:
-            print("читаем excel файлы")
-            async for data_dict in read_files_in_dir(data_dir):
-                data_dict_need = {
-                    k: (
-                        int(v)
-                        if k == "total" and isinstance(v, str) and v.isdigit()
-                        else (None if isinstance(v, float) and math.isnan(v) else v)
-                    )
-                    for k, v in data_dict.items()
-                    if k not in ignore_fields
-                }
-                async for data in get_data(data_dict_need):
-                    objects_to_save.append(data)
-                try:
-                    if objects_to_save:
-                        # print(objects_to_save)
-                        session.add_all(objects_to_save)
-                        objects_to_save.clear()
-                    else:
-                        print("нет новых данных")
-                except Exception as e:
-                    print(f"Ошибка при добавлении данных в сессию: {e}")
-                    logging.error(e)
-        try:
-            await session.commit()
-        except Exception as e:
-            print(f"Ошибка при коммите данных: {e}")
-            logging.error(e)
-            await session.rollback()
-        else:
-            print(
-                f"данные сохранены в базу в количестве {len(session.new)} экземпляров"
+        while (item := await batches_queue.get()) is not None:
+            batch, files = item
+            committed["rows"] += await flush(session, loader, batch, files)
+
+
+async def send_data(
+    mode=INGEST_MODE,
+    batch_size=INGEST_BATCH_SIZE,
+    max_rows=PIPELINE_MAX_ROWS,
+    workers=READ_WORKERS,
+    download=False,
+):
+    """
+    Загружает в базу новые и изменившиеся файлы бюллетеней.
+
+    Этапы (скачивание -> разбор -> проверка -> запись) связаны ограниченными
+    очередями, поэтому в памяти одновременно находится не больше max_rows строк
+    (с точностью до одной пачки), сколько бы лет истории ни загружалось.
+
+    Файлы пачки попадают в манифест ingested_files, а их даты - в trading_days,
+    trading_daily_rollups и справочник инструментов в той же
+    транзакции, что и их строки, поэтому после сбоя повторный запуск продолжит
+    с незагруженных файлов.
+    Отклоненные строки записываются в logs/dead_letter.jsonl. Если строки
+    загружены, увеличивается поколение данных, и API обновляет кеш; это
+    делается и тогда, когда загрузка прервалась после коммита части пачек.
+
+    Параметры:
+    - mode: способ записи (см. load_data.LOADERS).
+    - batch_size: строк в одной пачке записи.
+    - max_rows: ограничение строк между разбором и записью.
+    - workers: число процессов разбора (0 или 1 - разбор в отдельном потоке).
+    - download: запускать ли скачивание новых файлов одновременно с загрузкой.
+    """
+    loader = get_loader(mode)
+    parsers = max(workers, 1)
+
+    async with async_session() as session:
+        known = await get_known_files(session)
+
+    paths_queue = asyncio.Queue(maxsize=parsers * 2)
+    files_queue = asyncio.Queue(maxsize=parsers * 2)
+    batches_queue = asyncio.Queue(maxsize=max(max_rows // batch_size, 1))
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    committed = {"rows": 0}
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(
+                transform_stage(files_queue, batches_queue, parsers, batch_size)
             )
+            tg.create_task(load_stage(batches_queue, loader, committed))
+            seen = set()
+            parse_tasks = [
+                tg.create_task(
+                    parse_stage(paths_queue, files_queue, executor, seen, known)
+                )
+                for _ in range(parsers)
+            ]
+
+            print("читаем excel файлы")
+            await download_stage(paths_queue, known, download)
+            for _ in range(parsers):
+                await paths_queue.put(None)
+            await asyncio.gather(*parse_tasks)
+            for _ in range(parsers):
+                await files_queue.put(None)
+    finally:
+        if executor:
+            executor.shutdown()
+        # Закоммиченные пачки уже видны в базе, даже если загрузка прервалась
+        if committed["rows"]:
+            await bump_generation(await primary_lsn())
+
+    if committed["rows"]:
+        print(f"данные сохранены в базу в количестве {committed['rows']} экземпляров")
+    else:
+        print("нет новых данных")
 
 
 async def main():
     t0 = time()
-    await main_load()
-    logger_report.info(f"after main_load {time() - t0}")
-
     await start_db()
     logger_report.info(f"after start_db {time() - t0}")
 
-    await send_data()
+    await send_data(download=True)
     logger_report.info(f"after send_data {time() - t0}")
 
 
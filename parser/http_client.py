@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+load_dotenv()
+
+# Размер пула соединений и ограничение на один хост
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "30"))
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "15"))
+# Сколько секунд кешируются DNS-ответы (только async-клиент)
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+# Таймауты, секунды
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", "120"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+# Повторы: число попыток и параметры экспоненциальной задержки
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "30"))
+
+# Статусы, при которых запрос стоит повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def parse_retry_after(value):
+    """
+    Разбирает заголовок Retry-After (секунды или HTTP-дата).
+
+    Возвращает:
+    - задержку в секундах или None.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Задержка перед повтором: Retry-After сервера или экспоненциальная
+    задержка со случайным разбросом (full jitter).
+    """
+    delay = parse_retry_after(retry_after)
+    if delay is not None:
+        return min(delay, HTTP_BACKOFF_MAX)
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2**attempt))
+
+
+def create_session():
+    """
+    Создает requests.Session с пулом keep-alive соединений.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_LIMIT_PER_HOST, pool_maxsize=HTTP_POOL_SIZE
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_with_retries(session, url, headers, max_retries=HTTP_MAX_RETRIES, **kwargs):
+    """
+    GET-запрос через requests.Session с повторами при ошибках соединения,
+    429 и 5xx.
+
+    Возвращает:
+    - ответ (в том числе с ошибочным статусом после исчерпания попыток) или None.
+    """
+    for attempt in range(max_retries):
+        last_attempt = attempt == max_retries - 1
+        try:
+            response = session.get(
+                url,
+                headers=headers,
+                timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                **kwargs,
+            )
+        except requests.RequestException as e:
+            logging.warning(
+                f"Ошибка при запросе {url}: {e}. Попытка {attempt + 1} из {max_retries}."
+            )
+            if last_attempt:
+                return None
+            time.sleep(backoff_delay(attempt))
+            continue
+
+        if response.status_code not in RETRY_STATUSES or last_attempt:
+            return response
+        logging.warning(
+            f"Статус {response.status_code} при запросе {url}. "
+            f"Попытка {attempt + 1} из {max_retries}."
+        )
+        retry_after = response.headers.get("Retry-After")
+        response.close()
+        time.sleep(backoff_delay(attempt, retry_after))
+    return None
+
+
+def create_async_session(limit_per_host=HTTP_LIMIT_PER_HOST):
+    """
+    Создает aiohttp.ClientSession с пулом соединений, кешем DNS и таймаутами.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=HTTP_TOTAL_TIMEOUT,
+        connect=HTTP_CONNECT_TIMEOUT,
+        sock_read=HTTP_READ_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def async_get_with_retries(
+    session, url, headers, max_retries=HTTP_MAX_RETRIES
+):
+    """
+    GET-запрос через aiohttp.ClientSession с повторами при ошибках соединения,
+    таймаутах, 429 и 5xx.
+
+    Возвращает:
+    - ответ (в том числе с ошибочным статусом после исчерпания попыток) или None.
+      Ответ нужно освободить (release) после чтения.
+    """
+    for attempt in range(max_retries):
+        last_attempt = attempt == max_retries - 1
+        try:
+            response = await session.get(url, headers=headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(
+                f"Ошибка при запросе {url}: {e!r}. Попытка {attempt + 1} из {max_retries}."
+            )
+            if last_attempt:
+                return None
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+
+        if response.status not in RETRY_STATUSES or last_attempt:
+            return response
+        logging.warning(
+            f"Статус {response.status} при запросе {url}. "
+            f"Попытка {attempt + 1} из {max_retries}."
+        )
+        retry_after = response.headers.get("Retry-After")
+        response.release()
+        await asyncio.sleep(backoff_delay(attempt, retry_after))
+    return None
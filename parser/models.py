@@ -0,0 +1,216 @@
+from datetime import timedelta
+
+from sqlalchemy import (BigInteger, Column, Date, DateTime, Index, Integer,
+                        Numeric, String)
+from sqlalchemy.orm import DeclarativeBase
+
+
+# Модели общие для синхронного и асинхронного загрузчиков и API
+class Base(DeclarativeBase):
+    pass
+
+
+# Поля схемы Trades: хранятся в листьях индексов для index-only scan
+TRADE_INCLUDE = [
+    "exchange_product_id",
+    "exchange_product_name",
+    "delivery_basis_name",
+    "volume",
+    "total",
+    "count",
+]
+
+
+class Data(Base):
+    __tablename__ = "spimex_trading_results"
+
+    # Таблица секционирована по месяцам (RANGE по date), поэтому date входит
+    # в первичный ключ
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    exchange_product_id = Column(String)
+    exchange_product_name = Column(String)
+    oil_id = Column(String)
+    delivery_basis_id = Column(String)
+    delivery_basis_name = Column(String)
+    delivery_type_id = Column(String)
+    # Объем и оборот в бюллетене даны с точностью до копеек, договоры - целые
+    volume = Column(Numeric(20, 2))
+    total = Column(Numeric(20, 2))
+    count = Column(BigInteger)
+    date = Column(Date, primary_key=True)
+    created_on = Column(DateTime)
+    updated_on = Column(DateTime)
+
+    __table_args__ = (
+        # Индексы под запросы API, см. миграции 0002 и 0003
+        Index(
+            "idx_trading_results_filters",
+            "oil_id",
+            "delivery_type_id",
+            "delivery_basis_id",
+            "date",
+            "id",
+            postgresql_include=TRADE_INCLUDE,
+        ),
+        Index(
+            "idx_trading_results_date_covering",
+            "date",
+            "id",
+            postgresql_include=TRADE_INCLUDE,
+        ),
+        Index("brin_trading_results_date", "date", postgresql_using="brin"),
+        # Естественный ключ строки бюллетеня: повторная загрузка дня обновляет строки
+        Index(
+            "uq_trading_results_natural_key",
+            "date",
+            "exchange_product_id",
+            "delivery_basis_name",
+            unique=True,
+        ),
+        {"postgresql_partition_by": "RANGE (date)"},
+    )
+
+    def __repr__(self):
+        return str(
+            {
+                "exchange_product_id": self.exchange_product_id,
+                "exchange_product_name": self.exchange_product_name,
+                "delivery_basis_name": self.delivery_basis_name,
+                "volume": self.volume,
+                "total": self.total,
+                "count": self.count,
+            }
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, Data):
+            return False
+        return (
+            self.exchange_product_id == other.exchange_product_id
+            and self.exchange_product_name == other.exchange_product_name
+            and self.oil_id == other.oil_id
+            and self.delivery_basis_id == other.delivery_basis_id
+            and self.delivery_basis_name == other.delivery_basis_name
+            and self.delivery_type_id == other.delivery_type_id
+            and self.volume == other.volume
+            and self.total == other.total
+            and self.count == other.count
+        )
+
+
+# Последняя сделка по инструменту: ключ с убыванием задается выражениями колонок
+Index(
+    "idx_trading_results_product_latest",
+    Data.exchange_product_id,
+    Data.date.desc(),
+    Data.id.desc(),
+    postgresql_include=TRADE_INCLUDE[1:],
+)
+
+
+class IngestedFile(Base):
+    """Манифест загруженных файлов бюллетеней."""
+
+    __tablename__ = "ingested_files"
+
+    file_name = Column(String, primary_key=True)
+    bulletin_date = Column(Date)
+    size = Column(BigInteger)
+    # Время изменения файла, нс: по размеру и времени файл узнается без хеширования
+    mtime_ns = Column(BigInteger)
+    content_hash = Column(String(64))
+    rows_loaded = Column(Integer)
+    loaded_at = Column(DateTime)
+
+
+class Instrument(Base):
+    """
+    Справочник инструментов: наименование и составные части кода инструмента.
+    Пополняется загрузчиком по строкам каждой пачки.
+    """
+
+    __tablename__ = "instruments"
+
+    id = Column(Integer, primary_key=True)
+    exchange_product_id = Column(String, nullable=False, unique=True)
+    exchange_product_name = Column(String)
+    oil_id = Column(String)
+    delivery_basis_id = Column(String)
+    delivery_type_id = Column(String)
+
+    __table_args__ = (
+        Index(
+            "idx_instruments_filters",
+            "oil_id",
+            "delivery_type_id",
+            "delivery_basis_id",
+        ),
+    )
+
+
+class TradingDay(Base):
+    """Торговые дни: по строке на дату бюллетеня, обновляется при загрузке."""
+
+    __tablename__ = "trading_days"
+
+    date = Column(Date, primary_key=True)
+    row_count = Column(Integer)
+    total_volume = Column(Numeric(20, 2))
+    loaded_at = Column(DateTime)
+
+
+class DailyRollup(Base):
+    """
+    Итоги торгов за день по виду нефти, базису и типу поставки.
+    Пересчитываются загрузчиком для дат каждой загруженной пачки.
+    """
+
+    __tablename__ = "trading_daily_rollups"
+
+    date = Column(Date, primary_key=True)
+    oil_id = Column(String, primary_key=True)
+    delivery_basis_id = Column(String, primary_key=True)
+    delivery_type_id = Column(String, primary_key=True)
+    volume = Column(Numeric(20, 2))
+    total = Column(Numeric(20, 2))
+    count = Column(BigInteger)
+    instruments = Column(Integer)
+
+    __table_args__ = (
+        # Фильтры /get_dynamics по виду нефти с диапазоном дат
+        Index("idx_daily_rollups_oil_date", "oil_id", "date"),
+    )
+
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    version = Column(String, primary_key=True)
+    applied_on = Column(DateTime)
+
+
+# Секции spimex_trading_results, уже созданные в базе
+PARTITIONS_SQL = (
+    "SELECT child.relname FROM pg_inherits "
+    "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+    f"WHERE pg_inherits.inhparent = '{Data.__tablename__}'::regclass"
+)
+
+
+def month_partitions(dates, table=Data.__tablename__):
+    """
+    Описывает месячные секции таблицы сделок, в которые попадают даты.
+    table - секционированная таблица с той же схемой (по умолчанию основная).
+
+    Возвращает:
+    - словарь {имя секции: CREATE TABLE ... PARTITION OF ...}.
+    """
+    partitions = {}
+    for month in {day.replace(day=1) for day in dates}:
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        name = f"{table}_{month:%Y_%m}"
+        partitions[name] = (
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{month}') TO ('{next_month}')"
+        )
+    return partitions
@@ -3,8 +3,8 @@ import os
 import re
 import time
 from datetime import datetime
+from parser.http_client import create_session, get_with_retries
 
-import requests
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 
@@ -33,29 +33,19 @@ base_url = os.getenv("OIL_TRADES_RESULTS_API_URL")
 t0 = time.time()
 
 
-def try_request(url, headers, max_retries=3, delay=2):
-    """Попытка выполнить GET-запрос с несколькими повторными попытками."""
-    for attempt in range(1, max_retries + 1):
-        try:
-            response = requests.get(url, headers=headers)
-
-            return response
-        except requests.RequestException as e:
-            print(f"Ошибка при запросе {url}: {e}. Попытка {attempt} из {max_retries}.")
-            if attempt < max_retries:
-                time.sleep(delay)
-            else:
-                return None
+def load_file(year=2023):
+    with create_session() as session:
+        crawl(session, year)
 
 
-def load_file(year=2023):
+def crawl(session, year):
     count_files = 0
     page_number = 1
     while True:
         if count_files == 50:
             break
         url = f"{base_url}?page=page-{page_number}"
-        response = try_request(url, headers)
+        response = get_with_retries(session, url, headers)
         if response is None or response.status_code != 200:
             print(
                 f"Ошибка доступа к странице {page_number}: {response.status_code if response else 'нет ответа'}"
@@ -90,7 +80,9 @@ def load_file(year=2023):
                             print(f"Файл уже существует: {file_path}")
                             continue
 
-                        response_file = try_request(full_url, headers)
+                        response_file = get_with_retries(
+                            session, full_url, headers, stream=True
+                        )
                         if response_file and response_file.status_code == 200:
                             with open(file_path, "wb") as f:
                                 for chunk in response_file.iter_content(
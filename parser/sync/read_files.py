@@ -1,5 +1,7 @@
 import logging
 import os
+import re
+from datetime import datetime
 
 import pandas as pd
 
@@ -16,50 +18,57 @@ logging.basicConfig(
 )
 
 
+COLUMNS = {
+    "Код\nИнструмента": "exchange_product_id",
+    "Наименование\nИнструмента": "exchange_product_name",
+    "Базис\nпоставки": "delivery_basis_name",
+    "Объем\nДоговоров\nв единицах\nизмерения": "volume",
+    "Обьем\nДоговоров,\nруб.": "total",
+    "Количество\nДоговоров,\nшт.": "count",
+}
+
+
 def read_file():
     operations = []
     for filename in os.listdir(data_dir):
         filepath = os.path.join(data_dir, filename)
         if os.path.isfile(filepath):
             try:
+                df_header = pd.read_excel(filepath, header=None, skiprows=3, nrows=1)
+                date_match = re.search(
+                    r"\d{2}\.\d{2}\.\d{4}", str(df_header.iloc[0, 1])
+                )
                 df = pd.read_excel(filepath, skiprows=6)
             except Exception as e:
                 logging.error(f"Ошибка при чтении файла {filename}: {e}")
                 continue
 
-            try:
-                df["Количество\nДоговоров,\nшт."] = pd.to_numeric(
-                    df["Количество\nДоговоров,\nшт."], errors="coerce"
-                ).fillna(0)
-            except Exception as e:
-                logging.error(f"Ошибка при обработке данных в файле {filename}: {e}")
+            if not date_match:
+                logging.error(f"В файле {filename} не найдена дата бюллетеня")
                 continue
 
             try:
-                filtered_df = df[df["Количество\nДоговоров,\nшт."] > 0]
+                df = df.rename(columns=COLUMNS)[list(COLUMNS.values())]
+                df["count"] = pd.to_numeric(df["count"], errors="coerce").fillna(0)
             except Exception as e:
-                logging.error(f"Ошибка при фильтрации данных в файле {filename}: {e}")
+                logging.error(f"Ошибка при обработке данных в файле {filename}: {e}")
                 continue
 
-            if not filtered_df.empty:
-                for _, row in filtered_df.iterrows():
-                    try:
-                        operation = {
-                            "exchange_product_id": row["Код\nИнструмента"],
-                            "exchange_product_name": row["Наименование\nИнструмента"],
-                            "delivery_basis_name": row["Базис\nпоставки"],
-                            "volume": row["Объем\nДоговоров\nв единицах\nизмерения"],
-                            "total": row["Обьем\nДоговоров,\nруб."],
-                            "count": row["Количество\nДоговоров,\nшт."],
-                        }
-                        operations.append(operation)
+            filtered_df = df[
+                (df["count"] > 0)
+                & (df["exchange_product_id"].map(type) == str)
+                & df["delivery_basis_name"].notna()
+            ]
 
-                    except Exception as e:
-                        logging.error(
-                            f"Ошибка при обработке строки в файле {filename}: {e}"
-                        )
-                        continue
-            print(operations)
+            if not filtered_df.empty:
+                filtered_df = filtered_df.assign(
+                    date=datetime.strptime(date_match.group(), "%d.%m.%Y").date()
+                )
+                # Пропуски заменяем на None одной операцией над всей таблицей
+                filtered_df = filtered_df.astype(object).where(
+                    filtered_df.notna(), None
+                )
+                operations.extend(filtered_df.to_dict("records"))
     return operations
 
 
@@ -1,10 +1,17 @@
+import asyncio
+import csv
+import io
 import logging
 import math
 import os
 from datetime import datetime
+from parser.aggregates import refresh_statements
+from parser.async_download.cache_generation import bump_generation
+from parser.async_download.database import PRIMARY_LSN_SQL
+from parser.models import PARTITIONS_SQL, Data, month_partitions
 from parser.sync.data_parser import load_file
-from parser.sync.database import session
-from parser.sync.models import Data
+from parser.sync.database import Session
+from parser.sync.models import start_db
 from parser.sync.read_files import read_file
 from time import time
 
@@ -20,6 +27,42 @@ logging.basicConfig(
     ],
 )
 
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "5000"))
+
+COPY_COLUMNS = (
+    "exchange_product_id",
+    "exchange_product_name",
+    "oil_id",
+    "delivery_basis_id",
+    "delivery_basis_name",
+    "delivery_type_id",
+    "volume",
+    "total",
+    "count",
+    "date",
+    "created_on",
+    "updated_on",
+)
+
+NATURAL_KEY = ("date", "exchange_product_id", "delivery_basis_name")
+
+STAGING_TABLE = f"{Data.__tablename__}_staging"
+
+UPDATE_COLUMNS = [
+    column
+    for column in COPY_COLUMNS
+    if column not in NATURAL_KEY and column != "created_on"
+]
+
+# Слияние временной таблицы с основной: строки с тем же естественным ключом обновляются
+MERGE_SQL = (
+    f"INSERT INTO {Data.__tablename__} ({', '.join(COPY_COLUMNS)}) "
+    f"SELECT DISTINCT ON ({', '.join(NATURAL_KEY)}) {', '.join(COPY_COLUMNS)} "
+    f"FROM {STAGING_TABLE} ORDER BY {', '.join(NATURAL_KEY)} "
+    f"ON CONFLICT ({', '.join(NATURAL_KEY)}) DO UPDATE SET "
+    + ", ".join(f"{column} = EXCLUDED.{column}" for column in UPDATE_COLUMNS)
+)
+
 #
 # def get_data(data_dict):
 #     volume = data_dict.get("volume", 0)
@@ -139,8 +182,80 @@ logging.basicConfig(
 #         session.rollback()
 
 
-def send_data():
+def ensure_partitions(session, dates):
+    """
+    Создает недостающие месячные секции таблицы сделок в отдельной короткой
+    транзакции: CREATE TABLE ... PARTITION OF берет ACCESS EXCLUSIVE на таблицу
+    сделок, и в транзакции пачки запросы API ждали бы ее коммита.
+    """
+    cursor = session.connection().connection.cursor()
+    cursor.execute(PARTITIONS_SQL)
+    existing = {name for (name,) in cursor.fetchall()}
+    for name, statement in month_partitions(dates).items():
+        if name not in existing:
+            cursor.execute(statement)
+    session.commit()
+
+
+def copy_rows(session, rows):
+    """
+    Записывает пачку строк через COPY (psycopg2 copy_expert) во временную таблицу
+    и сливает ее с основной одним INSERT ... ON CONFLICT DO UPDATE.
+    В той же транзакции пересчитываются производные таблицы дат пачки.
+
+    Возвращает:
+    - количество записанных (вставленных или обновленных) строк, 0 при ошибке.
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    try:
+        dates = {row[COPY_COLUMNS.index("date")] for row in rows}
+        ensure_partitions(session, dates)
+        # После коммита сессия берет соединение заново
+        cursor = session.connection().connection.cursor()
+        cursor.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} ON COMMIT DELETE ROWS AS "
+            f"SELECT {', '.join(COPY_COLUMNS)} FROM {Data.__tablename__} WITH NO DATA"
+        )
+        cursor.copy_expert(
+            f"COPY {STAGING_TABLE} ({', '.join(COPY_COLUMNS)}) "
+            f"FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+        cursor.execute(MERGE_SQL)
+        written = cursor.rowcount
+        for statement in refresh_statements(dates):
+            session.execute(statement)
+        session.commit()
+    except Exception as e:
+        print(f"Ошибка при сохранении пачки данных: {e}")
+        logging.error(e)
+        session.rollback()
+        return 0
+    return written
+
+
+def send_data(batch_size=INGEST_BATCH_SIZE):
+    with Session() as session:
+        count_operation = load_rows(session, batch_size)
+        lsn = session.scalar(PRIMARY_LSN_SQL) if count_operation else None
+    if count_operation:
+        # Новые строки в таблице: кеш API должен перестать отдавать старые ответы
+        asyncio.run(bump_generation(lsn))
+    print(f"данные сохранены в базу в количестве {count_operation} экземпляров")
+
+
+def load_rows(session, batch_size):
+    """
+    Читает файлы и записывает строки пачками по batch_size.
+
+    Возвращает:
+    - количество записанных в базу строк (пачки, откатившиеся с ошибкой, не считаются).
+    """
     count_operation = 0
+    rows = []
     for data_dict in read_file():
         try:
             volume = data_dict.get("volume", 0)
@@ -154,101 +269,43 @@ def send_data():
                 total = 0
             if isinstance(count, float) and math.isnan(count):
                 count = 0
-
-            if count_operation == 10000:
-                break
+            # Колонка count целочисленная, а COPY не примет "5.0"
+            count = int(count)
 
             exchange_product_id = data_dict.get("exchange_product_id")
-            if exchange_product_id and isinstance(exchange_product_id, str):
-                oil_id = exchange_product_id[:4]
-                delivery_basis_id = exchange_product_id[4:7]
-                delivery_type_id = exchange_product_id[-1]
-            else:
-                oil_id = None
-                delivery_basis_id = None
-                delivery_type_id = None
-
-            data = Data(
-                exchange_product_id=exchange_product_id,
-                exchange_product_name=data_dict.get("exchange_product_name", None),
-                oil_id=oil_id,
-                delivery_basis_id=delivery_basis_id,
-                delivery_basis_name=data_dict.get("delivery_basis_name", None),
-                delivery_type_id=delivery_type_id,
-                volume=volume,
-                total=total,
-                count=count,
-                date=datetime.now(),
-                created_on=datetime.now(),
-                updated_on=datetime.now(),
-            )
-            print(data)
-
-            # Проверка на существование в бд
-            existing = (
-                session.query(Data)
-                .filter_by(exchange_product_id=exchange_product_id)
-                .first()
-            )
-            if existing:
-                ignore_fields = [
-                    "volume",
-                    "oil_id",
-                    "count",
-                    "date",
-                    "created_on",
-                    "updated_on",
-                    "id",
-                    "_sa_instance_state",
-                    "delivery_basis_id",
-                    "delivery_type_id",
+            now = datetime.now()
+            rows.append(
+                [
+                    exchange_product_id,
+                    data_dict.get("exchange_product_name"),
+                    exchange_product_id[:4],
+                    exchange_product_id[4:7],
+                    data_dict.get("delivery_basis_name"),
+                    exchange_product_id[-1],
+                    volume,
+                    total,
+                    count,
+                    data_dict.get("date"),
+                    now,
+                    now,
                 ]
-
-                # Получаем словарь из объекта ORM
-                existing_dict = {
-                    k: v for k, v in existing.__dict__.items() if k not in ignore_fields
-                }
-                # Теперь сравниваем
-                data_dict_need = {
-                    k: (
-                        int(v)
-                        if k == "total" and isinstance(v, str) and v.isdigit()
-                        else v
-                    )
-                    for k, v in data_dict.items()
-                    if k not in ignore_fields
-                }
-                if existing_dict == data_dict_need:
-                    print("Объекты идентичны")
-                    logging.info("Объекты идентичны, записи не будет")
-
-                else:
-                    count_operation += 1
-                    session.add(data)
-                    print(
-                        f"данные добавлены в сессию в количестве {count_operation} экземпляров"
-                    )
-            else:
-                count_operation += 1
-                session.add(data)
-                print(
-                    f"данные добавлены в сессию в количестве {count_operation} экземпляров"
-                )
+            )
         except Exception as e:
             print(f"Ошибка при обработке данных: {e}")
             logging.error(f"Ошибка: {e}")
 
-    try:
-        session.commit()
-        print(f"данные сохранены в базу в количестве {count_operation} экземпляров")
-    except Exception as e:
-        print(f"Ошибка при коммите сессии: {e}")
-        logging.error(e)
-        session.rollback()
+        if len(rows) >= batch_size:
+            count_operation += copy_rows(session, rows)
+            rows = []
+
+    if rows:
+        count_operation += copy_rows(session, rows)
+    return count_operation
 
 
 if __name__ == "__main__":
     t0 = time()
+    start_db()
     load_file()
     send_data()
     print(time() - t0)